@@ -1,24 +1,49 @@
 import argparse
+import asyncio
+import contextlib
 import csv
+import hashlib
+import json
 import logging
+import math
 import os
+import queue
 import random
+import re
+import sqlite3
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import date, datetime, timedelta
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from threading import Lock, local
+from threading import Condition, Event, Lock, Thread
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import pandas as pd
 import requests
 from dateutil import parser as date_parser
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 try:
     from tqdm import tqdm
 except ImportError:  # pragma: no cover
     tqdm = None
 
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+try:
+    import h2  # noqa: F401
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
 
 BASE_URL = "https://api.mercadopublico.cl/servicios/v1/publico/ordenesdecompra.json"
 ORGANISMOS = [
@@ -87,27 +112,1302 @@ COLUMNAS = [
     "Codigo producto",
 ]
 
+# Códigos de error que la API entrega con HTTP 200 cuando se excede la cantidad de peticiones simultáneas.
+CODIGOS_ERROR_SATURACION = {10500}
+
+# Órdenes por consulta de listado diaria, para estimar costos cuando la caché no tiene historial.
+OC_POR_CONSULTA_ESTIMADAS = {"global": 6000, "organismo": 5, "proveedor": 2}
+
+# Estados de orden de compra que ya no cambian: 9 = Cancelada, 12 = Recepción Conforme.
+ESTADOS_TERMINALES = {"9", "12"}
+
+# Latencia por petición en segundos, para estimar duraciones cuando la caché aún no tiene observaciones.
+LATENCIA_ESTIMADA = {"listado": 2.0, "detalle": 1.0}
+
+# Muestras de latencia de un endpoint necesarias antes de usar sus percentiles (--hedge, tiempos de espera).
+MUESTRAS_MINIMAS_LATENCIA = 20
+
+# El tiempo de lectura adaptativo es este múltiplo del percentil 99 de las latencias sanas o, antes de
+# tener muestras, del promedio guardado en la caché.
+PERCENTIL_TIMEOUT = 99
+FACTOR_TIMEOUT = 3.0
+FACTOR_TIMEOUT_PROMEDIO = 10.0
+
+# Segundos que espera un código diferido antes de volver a pedir su detalle.
+ESPERA_DIFERIDOS = 30.0
+
+# Peticiones diarias permitidas por ticket; el contador se reinicia a medianoche en Chile.
+CUOTA_DIARIA_POR_TICKET = 10000
+try:
+    ZONA_API = ZoneInfo("America/Santiago")
+except ZoneInfoNotFoundError:  # pragma: no cover
+    ZONA_API = None
+
+
+_TRANSPORTE: "TransporteRequests | TransporteHttpx | None" = None
+_TRANSPORTE_LOCK = Lock()
+_POOL: "PoolTickets | None" = None
+_CONCURRENCIA: "ConcurrenciaAdaptativa | None" = None
+_CIRCUITO: "CircuitoApi | None" = None
+_COBERTURA: "CoberturaDetalle | None" = None
+_TIMEOUTS: "TimeoutsAdaptativos | None" = None
+_METRICAS: Counter = Counter()
+_METRICAS_LOCK = Lock()
+_LATENCIAS: dict[str, deque] = {}
+
+
+def registrar_metrica(nombre: str, cantidad: int = 1):
+    with _METRICAS_LOCK:
+        _METRICAS[nombre] += cantidad
+
+
+def endpoint_de(params: dict) -> str:
+    return "detalle" if "codigo" in params else "listado"
+
+
+def registrar_latencia(endpoint: str, segundos: float):
+    with _METRICAS_LOCK:
+        _LATENCIAS.setdefault(endpoint, deque(maxlen=1000)).append(segundos)
+
+
+def latencias_observadas() -> dict[str, list[float]]:
+    with _METRICAS_LOCK:
+        return {endpoint: list(muestras) for endpoint, muestras in _LATENCIAS.items()}
+
+
+def percentil_latencia(endpoint: str, percentil: float) -> float | None:
+    with _METRICAS_LOCK:
+        muestras = sorted(_LATENCIAS.get(endpoint, ()))
+    if len(muestras) < MUESTRAS_MINIMAS_LATENCIA:
+        return None
+    return muestras[min(len(muestras) - 1, int(len(muestras) * percentil / 100))]
+
+
+def registrar_resumen(logger: logging.Logger):
+    with _METRICAS_LOCK:
+        metricas = dict(sorted(_METRICAS.items()))
+    if metricas:
+        logger.info("Resumen de peticiones: %s", ", ".join(f"{k}={v}" for k, v in metricas.items()))
+    if _POOL is not None:
+        logger.info("Uso de tickets: %s", _POOL.resumen())
+    if _TIMEOUTS is not None:
+        logger.info("Tiempos de lectura adaptativos: %s", _TIMEOUTS.resumen())
+
+
+def _registrar_conexion(inicio: float):
+    registrar_metrica("conexiones_abiertas")
+    registrar_metrica("ms_conexion", round((time.monotonic() - inicio) * 1000))
+
+
+class _ConexionHttpMedida(HTTPConnection):
+    def connect(self):
+        inicio = time.monotonic()
+        super().connect()
+        _registrar_conexion(inicio)
+
+
+class _ConexionHttpsMedida(HTTPSConnection):
+    def connect(self):
+        inicio = time.monotonic()
+        super().connect()
+        _registrar_conexion(inicio)
+
+
+class _PoolHttpMedido(HTTPConnectionPool):
+    ConnectionCls = _ConexionHttpMedida
+
+
+class _PoolHttpsMedido(HTTPSConnectionPool):
+    ConnectionCls = _ConexionHttpsMedida
+
+
+class AdaptadorMedido(HTTPAdapter):
+    # Igual al adaptador de requests, pero cada conexión nueva (TCP y TLS) queda en las métricas.
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _PoolHttpMedido, "https": _PoolHttpsMedido}
+
+
+class TransporteRequests:
+    # Una sola sesión para todos los hilos, con tantas conexiones persistentes como peticiones simultáneas.
+    nombre = "requests"
+
+    def __init__(self, conexiones: int):
+        self.conexiones = conexiones
+        self._sesion = requests.Session()
+        adaptador = AdaptadorMedido(pool_connections=1, pool_maxsize=conexiones)
+        self._sesion.mount("https://", adaptador)
+        self._sesion.mount("http://", adaptador)
+
+    def get(self, url: str, params=None, timeout=None):
+        return self._sesion.get(url, params=params, timeout=timeout)
+
+    def head(self, url: str, timeout=None):
+        return self._sesion.head(url, timeout=timeout)
+
+    def close(self):
+        self._sesion.close()
+
+
+def _traza_httpx():
+    inicio = [time.monotonic()]
+
+    def traza(evento: str, info: dict):
+        if evento in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            inicio[0] = time.monotonic()
+        elif evento == "connection.connect_tcp.complete":
+            _registrar_conexion(inicio[0])
+        elif evento == "connection.start_tls.complete":
+            registrar_metrica("ms_conexion", round((time.monotonic() - inicio[0]) * 1000))
+
+    return traza
+
+
+class TransporteHttpx:
+    # HTTP/2 multiplexa las peticiones simultáneas sobre unas pocas conexiones TLS.
+    nombre = "httpx"
+
+    def __init__(self, conexiones: int):
+        self.conexiones = conexiones
+        limites = httpx.Limits(max_connections=conexiones, max_keepalive_connections=conexiones)
+        self._cliente = httpx.Client(http2=True, limits=limites)
+
+    def get(self, url: str, params=None, timeout=None):
+        conexion, lectura = timeout
+        return self._cliente.get(
+            url,
+            params=params,
+            timeout=httpx.Timeout(lectura, connect=conexion),
+            extensions={"trace": _traza_httpx()},
+        )
+
+    def head(self, url: str, timeout=None):
+        return self._cliente.head(url, timeout=timeout, extensions={"trace": _traza_httpx()})
+
+    def close(self):
+        self._cliente.close()
+
+
+ERRORES_HTTP = (requests.RequestException,) + ((httpx.HTTPError,) if httpx is not None else ())
+ERRORES_TIEMPO = (requests.Timeout, asyncio.TimeoutError) + ((httpx.TimeoutException,) if httpx is not None else ())
+
+
+def configurar_transporte(nombre: str, conexiones: int):
+    global _TRANSPORTE
+    with _TRANSPORTE_LOCK:
+        if _TRANSPORTE is not None:
+            _TRANSPORTE.close()
+        _TRANSPORTE = TransporteHttpx(conexiones) if nombre == "httpx" else TransporteRequests(conexiones)
+
+
+def sesion_http():
+    global _TRANSPORTE
+    with _TRANSPORTE_LOCK:
+        if _TRANSPORTE is None:
+            _TRANSPORTE = TransporteRequests(1)
+        return _TRANSPORTE
+
 
-_THREAD_LOCAL = local()
-_SESSIONS: list[requests.Session] = []
-_SESSIONS_LOCK = Lock()
+def cerrar_transporte():
+    global _TRANSPORTE
+    with _TRANSPORTE_LOCK:
+        if _TRANSPORTE is not None:
+            _TRANSPORTE.close()
+            _TRANSPORTE = None
 
 
-def _get_thread_session() -> requests.Session:
-    session = getattr(_THREAD_LOCAL, "session", None)
-    if session is None:
-        session = requests.Session()
-        _THREAD_LOCAL.session = session
-        with _SESSIONS_LOCK:
-            _SESSIONS.append(session)
-    return session
+def precalentar_conexiones(cantidad: int, logger: logging.Logger):
+    # Abre las conexiones (TCP y TLS) antes de la primera petición con ticket; HEAD a la raíz no usa cuota.
+    transporte = sesion_http()
+    partes = BASE_URL.split("/", 3)
+    raiz = "/".join(partes[:3]) + "/"
+    inicio = time.monotonic()
 
+    def abrir(_):
+        try:
+            transporte.head(raiz, timeout=(10, 10))
+            return True
+        except ERRORES_HTTP as exc:
+            logger.debug("No se pudo precalentar una conexión: %s", exc)
+            return False
+
+    with ThreadPoolExecutor(max_workers=cantidad) as executor:
+        abiertas = sum(executor.map(abrir, range(cantidad)))
+    logger.info(
+        "Conexiones precalentadas con %s: %s de %s en %.2fs",
+        transporte.nombre,
+        abiertas,
+        cantidad,
+        time.monotonic() - inicio,
+    )
+
+
+class TokenBucket:
+    def __init__(self, tasa: float, rafaga: int):
+        self.tasa = tasa
+        self.capacidad = max(1, rafaga)
+        self._tokens = float(self.capacidad)
+        self._ultimo = time.monotonic()
+        self._lock = Lock()
+
+    def reservar(self) -> float:
+        # Cada llamada toma un token aunque el saldo quede negativo; la deuda se traduce en la espera
+        # que debe cumplir quien llama, así los turnos se reparten en orden sin bloquear el candado.
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+            self._ultimo = ahora
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.tasa
+
+    def adquirir(self):
+        espera = self.reservar()
+        if espera > 0:
+            time.sleep(espera)
+
+    def espera_estimada(self) -> float:
+        with self._lock:
+            tokens = min(self.capacidad, self._tokens + (time.monotonic() - self._ultimo) * self.tasa)
+            return 0.0 if tokens >= 1 else (1 - tokens) / self.tasa
+
+
+def hoy_api() -> date:
+    return datetime.now(ZONA_API).date()
+
+
+def segundos_hasta_reinicio_cuota() -> float:
+    ahora = datetime.now(ZONA_API)
+    manana = datetime(ahora.year, ahora.month, ahora.day, tzinfo=ahora.tzinfo) + timedelta(days=1)
+    return max(0.0, manana.timestamp() - time.time())
+
+
+class RegistroCuota:
+    def __init__(self, ruta: Path, cuota: int | None):
+        self.cuota = cuota or None
+        self._lock = Lock()
+        self._pendientes: Counter = Counter()
+        self._guardado = time.monotonic()
+        self._conn = sqlite3.connect(str(ruta), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cuota ("
+                "ticket TEXT NOT NULL, dia TEXT NOT NULL, peticiones INTEGER NOT NULL, PRIMARY KEY (ticket, dia))"
+            )
+
+    @staticmethod
+    def _clave(ticket: str) -> str:
+        # Solo se guarda un resumen del ticket para no dejarlo en claro en el disco.
+        return hashlib.sha256(ticket.encode("utf-8")).hexdigest()[:16]
+
+    def usadas(self, ticket: str) -> int:
+        clave = (self._clave(ticket), hoy_api().isoformat())
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT peticiones FROM cuota WHERE ticket = ? AND dia = ?", clave
+            ).fetchone()
+            return (fila[0] if fila else 0) + self._pendientes[clave]
+
+    def disponibles(self, ticket: str) -> int | None:
+        if self.cuota is None:
+            return None
+        return max(0, self.cuota - self.usadas(ticket))
+
+    def registrar(self, ticket: str):
+        with self._lock:
+            self._pendientes[(self._clave(ticket), hoy_api().isoformat())] += 1
+            if time.monotonic() - self._guardado >= 5:
+                self._guardar()
+
+    def _guardar(self):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO cuota (ticket, dia, peticiones) VALUES (?, ?, ?) "
+                "ON CONFLICT (ticket, dia) DO UPDATE SET peticiones = peticiones + excluded.peticiones",
+                [(ticket, dia, cantidad) for (ticket, dia), cantidad in self._pendientes.items()],
+            )
+        self._pendientes.clear()
+        self._guardado = time.monotonic()
+
+    def guardar(self):
+        with self._lock:
+            self._guardar()
+
+
+class EstadoTicket:
+    def __init__(self, ticket: str, tasa: float | None, rafaga: int):
+        self.ticket = ticket
+        self.bucket = TokenBucket(tasa, rafaga) if tasa else None
+        self.en_vuelo = 0
+        self.peticiones = 0
+        self.saturaciones = 0
+        self.bloqueado_hasta = 0.0
+        self.backoff = 0.0
+        self.ultima_saturacion = 0.0
+        self.motivo_baja: str | None = None
+
+    @property
+    def nombre(self) -> str:
+        return f"…{self.ticket[-4:]}"
+
+
+class PoolTickets:
+    def __init__(
+        self,
+        tickets: list[str],
+        tasa: float | None,
+        rafaga: int,
+        logger: logging.Logger,
+        max_simultaneas: int | None = None,
+        registro: RegistroCuota | None = None,
+    ):
+        self.tickets = [EstadoTicket(ticket, tasa, rafaga) for ticket in dict.fromkeys(tickets)]
+        self.max_simultaneas = max_simultaneas
+        self.registro = registro
+        self._logger = logger
+        self._lock = Lock()
+
+    def _elegir(self) -> tuple[EstadoTicket | None, float]:
+        with self._lock:
+            if self.registro is not None:
+                for t in self.tickets:
+                    if t.motivo_baja is None and self.registro.disponibles(t.ticket) == 0:
+                        t.motivo_baja = RESULTADO_CUOTA
+                        self._logger.warning("Ticket %s sin cuota disponible por hoy", t.nombre)
+            activos = [t for t in self.tickets if t.motivo_baja is None]
+            if not activos:
+                motivos = {t.motivo_baja for t in self.tickets}
+                if RESULTADO_CUOTA in motivos:
+                    raise ErrorCuotaAgotada("Todos los tickets agotaron su cuota diaria; se detiene la ejecución")
+                raise ErrorAutenticacion("La API rechazó todos los tickets; se aborta la ejecución")
+            ahora = time.monotonic()
+            candidatos = [
+                t
+                for t in activos
+                if t.bloqueado_hasta <= ahora and (self.max_simultaneas is None or t.en_vuelo < self.max_simultaneas)
+            ]
+            if not candidatos:
+                bloqueos = [t.bloqueado_hasta - ahora for t in activos if t.bloqueado_hasta > ahora]
+                return None, min(bloqueos) if bloqueos else 0.05
+            elegido = min(
+                candidatos,
+                key=lambda t: (t.bucket.espera_estimada() if t.bucket else 0.0, t.en_vuelo, t.peticiones),
+            )
+            elegido.en_vuelo += 1
+            elegido.peticiones += 1
+            return elegido, elegido.bucket.reservar() if elegido.bucket else 0.0
+
+    def adquirir(self) -> EstadoTicket:
+        while True:
+            ticket, espera = self._elegir()
+            if espera > 0:
+                time.sleep(espera)
+            if ticket is not None:
+                return ticket
+
+    async def adquirir_async(self) -> EstadoTicket:
+        while True:
+            ticket, espera = self._elegir()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            if ticket is not None:
+                return ticket
+
+    def tiene_holgura(self) -> bool:
+        # Hay algún ticket que puede enviar una petición ya, sin esperar al limitador ni a un bloqueo.
+        ahora = time.monotonic()
+        with self._lock:
+            return any(
+                t.motivo_baja is None
+                and t.bloqueado_hasta <= ahora
+                and (self.max_simultaneas is None or t.en_vuelo < self.max_simultaneas)
+                and (t.bucket is None or t.bucket.espera_estimada() == 0)
+                for t in self.tickets
+            )
+
+    def hay_alternativa(self, actual: EstadoTicket) -> bool:
+        ahora = time.monotonic()
+        with self._lock:
+            return any(
+                t is not actual and t.motivo_baja is None and t.bloqueado_hasta <= ahora for t in self.tickets
+            )
+
+    def registrar(self, ticket: EstadoTicket, resultado: str, retry_after: float | None):
+        if self.registro is not None:
+            self.registro.registrar(ticket.ticket)
+        with self._lock:
+            ticket.en_vuelo -= 1
+            if resultado == RESULTADO_SATURACION:
+                ticket.saturaciones += 1
+                ahora = time.monotonic()
+                # Como en ConcurrenciaAdaptativa, el backoff se duplica una vez por ventana: las saturaciones
+                # de peticiones que ya estaban en curso no vuelven a duplicarlo.
+                if ahora - ticket.ultima_saturacion >= max(1.0, ticket.backoff):
+                    ticket.backoff = min(max(ticket.backoff * 2, 1.0), 60.0)
+                    ticket.ultima_saturacion = ahora
+                pausa = retry_after if retry_after is not None else ticket.backoff
+                ticket.bloqueado_hasta = max(ticket.bloqueado_hasta, ahora + pausa)
+            elif resultado == RESULTADO_OK:
+                ticket.backoff = 0.0
+            elif resultado in (RESULTADO_AUTENTICACION, RESULTADO_CUOTA) and ticket.motivo_baja is None:
+                ticket.motivo_baja = resultado
+                restantes = sum(1 for t in self.tickets if t.motivo_baja is None)
+                self._logger.warning(
+                    "Ticket %s dado de baja (%s); quedan %s tickets disponibles", ticket.nombre, resultado, restantes
+                )
+
+    def reactivar_cuota(self):
+        with self._lock:
+            for t in self.tickets:
+                if t.motivo_baja == RESULTADO_CUOTA:
+                    t.motivo_baja = None
+
+    def cuota_disponible(self) -> tuple[int, int] | None:
+        # (peticiones que quedan hoy, peticiones por día) sumando los tickets aún utilizables.
+        if self.registro is None or self.registro.cuota is None:
+            return None
+        with self._lock:
+            activos = [t for t in self.tickets if t.motivo_baja != RESULTADO_AUTENTICACION]
+        return sum(self.registro.disponibles(t.ticket) for t in activos), self.registro.cuota * len(activos)
+
+    def resumen(self) -> str:
+        with self._lock:
+            return "; ".join(
+                f"{t.nombre}: peticiones={t.peticiones}, saturaciones={t.saturaciones}"
+                + (f", usadas_hoy={self.registro.usadas(t.ticket)}" if self.registro is not None else "")
+                + (f", baja={t.motivo_baja}" if t.motivo_baja else "")
+                for t in self.tickets
+            )
+
+
+def configurar_pool(
+    tickets: list[str], tasa: float | None, rafaga: int, logger, max_simultaneas=None, registro=None
+):
+    global _POOL
+    _POOL = PoolTickets(tickets, tasa, rafaga, logger, max_simultaneas, registro)
+
+
+class ConcurrenciaAdaptativa:
+    def __init__(self, maximo: int, logger: logging.Logger, minimo: int = 1):
+        self.minimo = minimo
+        self.maximo = max(minimo, maximo)
+        self.limite = float(max(minimo, maximo // 4))
+        self.en_vuelo = 0
+        self._logger = logger
+        self._condicion = Condition()
+        self._latencia_media: float | None = None
+        self._latencia_base: float | None = None
+        self._ultima_reduccion = 0.0
+
+    @property
+    def nivel(self) -> int:
+        return int(self.limite)
+
+    def intentar_adquirir(self) -> bool:
+        with self._condicion:
+            if self.en_vuelo >= self.nivel:
+                return False
+            self.en_vuelo += 1
+            return True
+
+    def adquirir(self):
+        with self._condicion:
+            while self.en_vuelo >= self.nivel:
+                self._condicion.wait()
+            self.en_vuelo += 1
+
+    async def adquirir_async(self):
+        while not self.intentar_adquirir():
+            await asyncio.sleep(0.05)
+
+    def devolver(self):
+        # Libera un lugar tomado sin que llegara a enviarse la petición; no cuenta para el ajuste.
+        with self._condicion:
+            self.en_vuelo -= 1
+            self._condicion.notify_all()
+
+    def liberar(self, resultado: str, latencia: float):
+        with self._condicion:
+            self.en_vuelo -= 1
+            anterior = self.nivel
+            congestion = resultado in RESULTADOS_REINTENTABLES
+            if resultado == RESULTADO_OK:
+                media = latencia if self._latencia_media is None else 0.8 * self._latencia_media + 0.2 * latencia
+                self._latencia_media = media
+                self._latencia_base = media if self._latencia_base is None else min(self._latencia_base, media)
+                congestion = media > 2 * self._latencia_base
+            ahora = time.monotonic()
+            if congestion:
+                # Una sola reducción por ventana: las respuestas de peticiones que ya estaban en curso
+                # reflejan la congestión anterior y no deben volver a reducir el límite.
+                if ahora - self._ultima_reduccion >= max(1.0, self._latencia_media or 0.0):
+                    self.limite = max(float(self.minimo), self.limite * 0.5)
+                    self._ultima_reduccion = ahora
+                    if self._latencia_media is not None:
+                        self._latencia_base = self._latencia_media
+            elif resultado == RESULTADO_OK:
+                self.limite = min(float(self.maximo), self.limite + 1 / max(self.limite, 1.0))
+            nivel = self.nivel
+            self._condicion.notify_all()
+        if nivel != anterior:
+            self._logger.info("Concurrencia adaptativa: %s -> %s peticiones simultáneas", anterior, nivel)
+
+
+class ErrorFatalApi(Exception):
+    pass
+
+
+class ErrorAutenticacion(ErrorFatalApi):
+    pass
+
+
+class ErrorCuotaAgotada(ErrorFatalApi):
+    pass
+
+
+class PeticionDiferida(Exception):
+    def __init__(self, intentos: int):
+        super().__init__(f"{intentos} intentos fallidos")
+        self.intentos = intentos
+
+
+class CircuitoApi:
+    def __init__(self, umbral: int, pausa: float, logger: logging.Logger, pausa_maxima: float = 300.0):
+        self.umbral = max(1, umbral)
+        self.pausa_base = pausa
+        self.pausa_maxima = max(pausa, pausa_maxima)
+        self._logger = logger
+        self._lock = Lock()
+        self._fallos = 0
+        self._abierto_hasta: float | None = None
+        self._pausa = pausa
+        self._sonda_en_curso = False
+
+    def _turno(self) -> tuple[float, bool]:
+        # Devuelve (espera, es_sonda). Con el circuito abierto todos esperan; al vencer la pausa
+        # solo una petición sale como sonda y el resto aguarda su resultado.
+        with self._lock:
+            if self._abierto_hasta is None:
+                return 0.0, False
+            restante = self._abierto_hasta - time.monotonic()
+            if restante > 0:
+                return restante, False
+            if self._sonda_en_curso:
+                return 0.2, False
+            self._sonda_en_curso = True
+            return 0.0, True
+
+    def esperar_turno(self) -> bool:
+        while True:
+            espera, es_sonda = self._turno()
+            if espera <= 0:
+                return es_sonda
+            time.sleep(espera)
+
+    async def esperar_turno_async(self) -> bool:
+        while True:
+            espera, es_sonda = self._turno()
+            if espera <= 0:
+                return es_sonda
+            await asyncio.sleep(espera)
+
+    def abierto(self) -> bool:
+        with self._lock:
+            return self._abierto_hasta is not None
+
+    def liberar_sonda(self):
+        # La sonda no llegó a enviarse (por ejemplo, sin ticket con cuota): el circuito sigue abierto y la
+        # próxima petición que pida turno sale como sonda.
+        with self._lock:
+            self._sonda_en_curso = False
+
+    def espera_pendiente(self) -> float:
+        with self._lock:
+            if self._abierto_hasta is None:
+                return 0.0
+            return max(0.0, self._abierto_hasta - time.monotonic())
+
+    def registrar(self, resultado: str, es_sonda: bool, retry_after: float | None):
+        with self._lock:
+            if resultado not in RESULTADOS_REINTENTABLES:
+                self._fallos = 0
+                if es_sonda:
+                    self._sonda_en_curso = False
+                    self._abierto_hasta = None
+                    self._pausa = self.pausa_base
+                    self._logger.info("Circuito cerrado: la API volvió a responder")
+                return
+            self._fallos += 1
+            if es_sonda:
+                self._sonda_en_curso = False
+                self._pausa = min(self._pausa * 2, self.pausa_maxima)
+            elif self._abierto_hasta is not None or self._fallos < self.umbral:
+                return
+            # Si la API indica cuánto esperar, esa es la pausa; la propia solo se usa sin Retry-After.
+            pausa = retry_after if retry_after is not None else self._pausa
+            self._abierto_hasta = time.monotonic() + pausa
+            self._logger.warning(
+                "Circuito abierto por %.1fs tras %s fallos consecutivos; se pausan todas las peticiones",
+                pausa,
+                self._fallos,
+            )
+
+
+def configurar_circuito(umbral: int, pausa: float, logger: logging.Logger):
+    global _CIRCUITO
+    _CIRCUITO = CircuitoApi(umbral, pausa, logger)
+
+
+def configurar_concurrencia(adaptativa: bool, maximo: int, logger: logging.Logger):
+    global _CONCURRENCIA
+    _CONCURRENCIA = ConcurrenciaAdaptativa(maximo, logger) if adaptativa else None
+
+
+class CoberturaDetalle:
+    # Si un detalle tarda más que el percentil observado, se envía un duplicado y se usa la primera respuesta.
+    # Los duplicados no superan la fracción `presupuesto` de los detalles pedidos y solo salen si el
+    # limitador y el circuito los dejan pasar sin esperar.
+    def __init__(self, percentil: float, presupuesto: float, hilos: int):
+        self.percentil = percentil
+        self.presupuesto = presupuesto
+        self.ejecutor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="cobertura")
+        self.peticiones = 0
+        self.coberturas = 0
+        self._umbral: float | None = None
+        self._calculado = 0.0
+        self._lock = Lock()
+
+    def registrar_peticion(self) -> float | None:
+        # Cuenta un detalle más para el presupuesto y devuelve el umbral vigente (None sin muestras suficientes).
+        ahora = time.monotonic()
+        with self._lock:
+            self.peticiones += 1
+            if self._umbral is not None and ahora - self._calculado < 1.0:
+                return self._umbral
+            self._calculado = ahora
+        umbral = percentil_latencia("detalle", self.percentil)
+        with self._lock:
+            self._umbral = umbral
+        return umbral
+
+    def autorizar(self) -> bool:
+        if _CIRCUITO is not None and _CIRCUITO.abierto():
+            return False
+        if _POOL is not None and not _POOL.tiene_holgura():
+            return False
+        with self._lock:
+            if self.coberturas + 1 > self.presupuesto * self.peticiones:
+                return False
+            self.coberturas += 1
+            return True
+
+    def cerrar(self):
+        self.ejecutor.shutdown(wait=False, cancel_futures=True)
+
+
+def configurar_cobertura(percentil: float, presupuesto: float, hilos: int):
+    global _COBERTURA
+    _COBERTURA = CoberturaDetalle(percentil, presupuesto, hilos) if percentil else None
+
+
+class TimeoutsAdaptativos:
+    # Tiempo de lectura por endpoint derivado de las latencias sanas, acotado entre `minimo` y el --timeout
+    # indicado. Cada reintento duplica el valor para que una respuesta lenta pero válida termine pasando.
+    def __init__(self, minimo: float, maximo: float, promedios: dict[str, float] | None = None):
+        self.minimo = minimo
+        self.maximo = maximo
+        self._promedios = promedios or {}
+        self._bases: dict[str, tuple[float, float | None]] = {}
+        self._lock = Lock()
+
+    def _base(self, endpoint: str) -> float | None:
+        ahora = time.monotonic()
+        with self._lock:
+            calculado, base = self._bases.get(endpoint, (0.0, None))
+            if base is not None and ahora - calculado < 1.0:
+                return base
+        percentil = percentil_latencia(endpoint, PERCENTIL_TIMEOUT)
+        if percentil is not None:
+            base = percentil * FACTOR_TIMEOUT
+        elif endpoint in self._promedios:
+            base = self._promedios[endpoint] * FACTOR_TIMEOUT_PROMEDIO
+        else:
+            base = None
+        with self._lock:
+            self._bases[endpoint] = (ahora, base)
+        return base
+
+    def calcular(self, endpoint: str, intento: int) -> float:
+        base = self._base(endpoint)
+        if base is None:
+            return self.maximo
+        return min(self.maximo, max(self.minimo, base) * 2 ** min(intento - 1, 10))
+
+    def resumen(self) -> str:
+        with self._lock:
+            bases = {endpoint: base for endpoint, (_, base) in sorted(self._bases.items())}
+        return ", ".join(
+            f"{endpoint}={min(self.maximo, max(self.minimo, base)):.1f}s"
+            if base is not None
+            else f"{endpoint}=sin muestras"
+            for endpoint, base in bases.items()
+        ) or "sin peticiones"
+
+
+def configurar_timeouts(minimo: float | None, maximo: float, promedios: dict[str, float] | None = None):
+    global _TIMEOUTS
+    _TIMEOUTS = TimeoutsAdaptativos(minimo, maximo, promedios) if minimo else None
+
+
+def timeout_lectura(endpoint: str, maximo: float, intento: int) -> float:
+    return min(maximo, _TIMEOUTS.calcular(endpoint, intento)) if _TIMEOUTS is not None else maximo
+
+
+def prefijo_codigo(codigo: str) -> str:
+    # El código de una OC tiene la forma <unidad compradora>-<correlativo>-<tipo y año>, p. ej. 2097-241-SE14.
+    return codigo.split("-", 1)[0]
+
+
+def organismo_de_registro(registro: dict) -> str:
+    return normalizar_texto(registro.get("CodigoOrganismo") or safe_get(registro, "Comprador", "CodigoOrganismo"))
+
+
+def anio_de_codigo(codigo: str) -> int | None:
+    # Los códigos de orden terminan en el tipo de compra y el año de creación, por ejemplo "1057501-123-SE25".
+    coincidencia = re.search(r"-[A-Z]{2}(\d{2})$", codigo)
+    return 2000 + int(coincidencia.group(1)) if coincidencia else None
+
+
+class PrefiltroFechas:
+    # Descarta antes de pedir el detalle las órdenes que con seguridad se crearon fuera del rango.
+    def __init__(self, modo: str, desde_dt: date, hasta_dt: date, cache=None):
+        self.modo = modo
+        self.desde = desde_dt
+        self.hasta = hasta_dt
+        self._cache = cache
+        self._descartados: dict[str, str] = {}
+        self._lock = Lock()
+
+    def evitados(self) -> int:
+        # Cada código cuenta una vez (aunque se repita en varios días, en la caché o en la verificación) y solo si
+        # su detalle se habría descargado, es decir, si no estaba ya en la caché de detalle.
+        with self._lock:
+            descartados = dict(self._descartados)
+        if self._cache is None:
+            return len(descartados)
+        return sum(1 for codigo, estado in descartados.items() if self._cache.obtener_detalle(codigo, estado) is None)
+
+    def descarta(self, registro: dict, codigo: str) -> bool:
+        if self.modo == "no":
+            return False
+        anio = anio_de_codigo(codigo)
+        fuera = anio is not None and not self.desde.year <= anio <= self.hasta.year
+        if not fuera and self.modo == "completo":
+            fecha = parse_fecha_json(registro.get("FechaCreacion") or safe_get(registro, "Fechas", "FechaCreacion"))
+            fuera = fecha is not None and not self.desde <= fecha <= self.hasta
+        if fuera:
+            with self._lock:
+                self._descartados[codigo] = normalizar_estado(registro.get("CodigoEstado"))
+        return fuera
+
+
+def proveedor_de_registro(registro: dict) -> str:
+    return normalizar_texto(registro.get("CodigoProveedor") or safe_get(registro, "Proveedor", "Codigo"))
+
+
+class PlanConsulta:
+    PARAMETROS = {"organismo": "CodigoOrganismo", "proveedor": "CodigoProveedor"}
+
+    def __init__(
+        self,
+        dimension: str,
+        organismos=None,
+        proveedores=None,
+        organismos_por_prefijo: dict[str, str] | None = None,
+        solo_prefijos_conocidos: bool = False,
+        inicios: dict[str, date] | None = None,
+        fragmento: tuple[int, int] | None = None,
+    ):
+        self.dimension = dimension
+        # None significa "sin filtro" en esa dimensión (todos los organismos o todos los proveedores).
+        self.organismos = list(organismos) if organismos is not None else None
+        self.proveedores = list(proveedores) if proveedores else None
+        self._organismos_por_prefijo = organismos_por_prefijo or {}
+        self._solo_prefijos_conocidos = solo_prefijos_conocidos
+        # Primer día a listar por organismo ("*" sin filtro de organismo) en modo incremental.
+        self.inicios = inicios
+        # Con --shard i/n este nodo solo lista las combinaciones (día, clave) que le asigna el hash.
+        self.fragmento = fragmento
+
+    def claves(self) -> list[str]:
+        if self.dimension == "organismo":
+            return self.organismos
+        if self.dimension == "proveedor":
+            return self.proveedores
+        return ["*"]
+
+    def claves_del_dia(self, dia: date) -> list[str]:
+        if self.inicios is None:
+            claves = self.claves()
+        elif self.dimension == "organismo":
+            claves = [clave for clave in self.claves() if clave in self.inicios and self.inicios[clave] <= dia]
+        else:
+            # Una consulta global o por proveedor cubre a todos los organismos a la vez.
+            claves = self.claves() if min(self.inicios.values()) <= dia else []
+        if self.fragmento is not None:
+            claves = [clave for clave in claves if en_fragmento(f"{dia.isoformat()}|{clave}", self.fragmento)]
+        return claves
+
+    def params(self, dia: date, clave: str) -> dict:
+        params = {"fecha": to_api_date(dia)}
+        if self.dimension in self.PARAMETROS:
+            params[self.PARAMETROS[self.dimension]] = clave
+        return params
+
+    def filtra_organismo(self) -> bool:
+        return self.organismos is not None and self.dimension != "organismo"
+
+    def filtra_proveedor(self) -> bool:
+        return self.proveedores is not None and self.dimension != "proveedor"
+
+    def evaluar_registro(self, registro: dict, codigo: str) -> str:
+        # "incluir": el registro cumple los filtros; "descartar": no los cumple; "verificar": hace falta el detalle.
+        pendiente = False
+        if self.filtra_organismo():
+            organismo = organismo_de_registro(registro) or self._organismos_por_prefijo.get(prefijo_codigo(codigo))
+            if organismo:
+                if organismo not in self.organismos:
+                    return "descartar"
+            elif self._solo_prefijos_conocidos:
+                return "descartar"
+            else:
+                pendiente = True
+        if self.filtra_proveedor():
+            proveedor = proveedor_de_registro(registro)
+            if proveedor:
+                if proveedor not in self.proveedores:
+                    return "descartar"
+            else:
+                pendiente = True
+        return "verificar" if pendiente else "incluir"
+
+    def admite_registro(self, registro: dict, codigo: str) -> bool:
+        return self.evaluar_registro(registro, codigo) != "descartar"
+
+    def admite_oc(self, oc: dict) -> bool:
+        if self.filtra_organismo():
+            if normalizar_texto(safe_get(oc, "Comprador", "CodigoOrganismo")) not in self.organismos:
+                return False
+        if self.filtra_proveedor():
+            if normalizar_texto(safe_get(oc, "Proveedor", "Codigo")) not in self.proveedores:
+                return False
+        return True
+
+
+def planificar_consulta(
+    organismos, proveedores, desde_dt: date, hasta_dt: date, args, cache, logger, inicios=None
+) -> PlanConsulta:
+    mapa = cache.organismos_por_prefijo() if cache is not None else {}
+    opciones = (mapa, args.solo_prefijos_conocidos, inicios, args.shard)
+    candidatos = {"global": PlanConsulta("global", organismos, proveedores, *opciones)}
+    if organismos is not None:
+        candidatos["organismo"] = PlanConsulta("organismo", organismos, proveedores, *opciones)
+    if proveedores:
+        candidatos["proveedor"] = PlanConsulta("proveedor", organismos, proveedores, *opciones)
+
+    # Costo diario = consultas de listado + detalles que solo sirven para descartar la orden (los que el
+    # plan no puede filtrar con el listado). Los descartes se estiman con los listados guardados en la
+    # caché para esa dimensión o, sin historial, con un volumen típico por consulta.
+    costos: dict[str, float] = {}
+    for dimension, plan in candidatos.items():
+        consultas = sum(len(plan.claves_del_dia(dia)) for dia in rango_fechas(desde_dt, hasta_dt))
+        historial = cache.listados_guardados(dimension) if cache is not None else []
+        if historial:
+            por_consulta = sum(
+                1
+                for payload in historial
+                for registro in payload.get("Listado") or []
+                if plan.evaluar_registro(registro, str(registro.get("Codigo") or "")) == "verificar"
+            ) / len(historial)
+        elif plan.organismos is None and plan.proveedores is None:
+            por_consulta = 0.0
+        elif (plan.filtra_organismo() and not plan._solo_prefijos_conocidos) or plan.filtra_proveedor():
+            por_consulta = float(OC_POR_CONSULTA_ESTIMADAS[dimension])
+        else:
+            por_consulta = 0.0
+        costos[dimension] = consultas * (1 + por_consulta)
+
+    dimension = min(costos, key=costos.get) if args.estrategia == "auto" else args.estrategia
+    if dimension not in candidatos:
+        raise ValueError(f"La estrategia {dimension} no es aplicable: falta la lista de códigos correspondiente")
+    logger.info(
+        "Plan de listado: %s (costo estimado en peticiones: %s)",
+        dimension,
+        ", ".join(f"{nombre}={costo:.0f}" for nombre, costo in costos.items()),
+    )
+    if dimension != "organismo" and organismos is not None and args.solo_prefijos_conocidos:
+        if not set(mapa.values()).issuperset(organismos):
+            logger.warning("Hay organismos sin prefijos conocidos en la caché; sus órdenes se omitirán del listado")
+    return candidatos[dimension]
+
+
+def estimar_costo_por_dia(
+    plan: PlanConsulta, desde_dt: date, hasta_dt: date, cache, bitacora=None, modo_prefiltro: str = "no"
+) -> dict:
+    # Devuelve, por día, (consultas de listado que se harán, detalles estimados). Las consultas ya guardadas
+    # (en la caché o en la bitácora) no cuestan listado y solo suman los detalles que faltan; el resto suma
+    # el promedio de órdenes admitidas por consulta de esa misma clave o, sin historial, de la dimensión.
+    prefiltro = PrefiltroFechas(modo_prefiltro, desde_dt, hasta_dt)
+
+    def admitidas(payloads: list[dict]) -> float:
+        return sum(len(extraer_codigos(payload, plan, prefiltro)) for payload in payloads) / len(payloads)
+
+    historial = cache.listados_por_clave(plan.dimension) if cache is not None else {}
+    por_clave = {clave: admitidas(payloads) for clave, payloads in historial.items()}
+    todos = [payload for payloads in historial.values() for payload in payloads]
+    por_defecto = admitidas(todos) if todos else float(OC_POR_CONSULTA_ESTIMADAS[plan.dimension])
+    completados = bitacora.detalles if bitacora is not None else set()
+    estimacion: dict[date, tuple[int, float]] = {}
+    for dia in rango_fechas(desde_dt, hasta_dt):
+        listados = 0
+        detalles = 0.0
+        for clave in plan.claves_del_dia(dia):
+            params = plan.params(dia, clave)
+            if bitacora is not None and clave_consulta(params) in bitacora.listados:
+                codigos = bitacora.listados[clave_consulta(params)]
+            else:
+                payload = cache.obtener_listado(dia, params) if cache is not None else None
+                if payload is None:
+                    listados += 1
+                    detalles += por_clave.get(clave, por_defecto)
+                    continue
+                codigos = extraer_codigos(payload, plan, prefiltro)
+            detalles += sum(
+                1
+                for codigo, estado in codigos
+                if codigo not in completados and (cache is None or cache.obtener_detalle(codigo, estado) is None)
+            )
+        estimacion[dia] = (listados, detalles)
+    return estimacion
+
+
+def dividir_por_cuota(estimacion: dict, disponible_hoy: int, capacidad_diaria: int) -> list[list[date]]:
+    # Cada tramo se ejecuta con la cuota de un día; el primero puede quedar vacío si hoy no alcanza ni
+    # para el primer día del rango. Un día que por sí solo supera la capacidad diaria forma su propio tramo.
+    tramos: list[list[date]] = [[]]
+    restante = disponible_hoy
+    for dia, peticiones in estimacion.items():
+        if peticiones > restante and (tramos[-1] or restante < capacidad_diaria):
+            tramos.append([])
+            restante = capacidad_diaria
+        tramos[-1].append(dia)
+        restante -= peticiones
+    return tramos
+
+
+def planificar_cuota(
+    plan: PlanConsulta, args, cache, bitacora, logger, costos=None, desde_dt: date | None = None
+) -> list[list[date]]:
+    desde_dt = desde_dt or args.desde
+    dias = list(rango_fechas(desde_dt, args.hasta))
+    cuota = _POOL.cuota_disponible() if _POOL is not None else None
+    if cuota is None:
+        return [dias]
+    disponible_hoy, capacidad_diaria = cuota
+    costos = costos or estimar_costo_por_dia(plan, desde_dt, args.hasta, cache, bitacora, args.prefiltro)
+    estimacion = {dia: math.ceil(listados + detalles) for dia, (listados, detalles) in costos.items()}
+    total = sum(estimacion.values())
+    logger.info(
+        "Cuota diaria: %s peticiones estimadas, %s disponibles hoy (%s por día)",
+        total,
+        disponible_hoy,
+        capacidad_diaria,
+    )
+    if total <= disponible_hoy:
+        return [dias]
+    tramos = dividir_por_cuota(estimacion, disponible_hoy, capacidad_diaria)
+    logger.warning(
+        "La cuota disponible no alcanza para todo el rango; se divide en %s tramos diarios: %s",
+        len(tramos),
+        ", ".join(
+            f"{tramo[0].isoformat()}..{tramo[-1].isoformat()}" if tramo else "(sin cuota hoy)" for tramo in tramos
+        ),
+    )
+    return tramos
+
+
+def clave_consulta(params: dict) -> str:
+    return "&".join(f"{k}={v}" for k, v in sorted(params.items()) if k != "ticket")
+
+
+class CacheApi:
+    def __init__(self, ruta: Path, dias_inmutable: int, ttl: float, ttl_detalle: float):
+        self.dias_inmutable = dias_inmutable
+        self.ttl = ttl
+        self.ttl_detalle = ttl_detalle
+        self._lock = Lock()
+        self._conn = sqlite3.connect(str(ruta), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS listado ("
+                "clave TEXT PRIMARY KEY, fecha TEXT NOT NULL, payload TEXT NOT NULL, guardado REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS detalle ("
+                "codigo TEXT PRIMARY KEY, estado TEXT NOT NULL, payload TEXT NOT NULL, guardado REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS prefijos (prefijo TEXT PRIMARY KEY, organismo TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS latencia ("
+                "endpoint TEXT PRIMARY KEY, muestras INTEGER NOT NULL, promedio REAL NOT NULL)"
+            )
+
+    def vigente(self, dia: date, guardado: float) -> bool:
+        # Un día se considera inmutable solo si ya era antiguo cuando se guardó la respuesta.
+        if (datetime.fromtimestamp(guardado).date() - dia).days >= self.dias_inmutable:
+            return True
+        return time.time() - guardado < self.ttl
+
+    def obtener_listado(self, dia: date, params: dict) -> dict | None:
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT payload, guardado FROM listado WHERE clave = ?", (clave_consulta(params),)
+            ).fetchone()
+        if fila is None or not self.vigente(dia, fila[1]):
+            return None
+        return json.loads(fila[0])
+
+    def guardar_listado(self, dia: date, params: dict, payload: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO listado (clave, fecha, payload, guardado) VALUES (?, ?, ?, ?)",
+                (clave_consulta(params), dia.isoformat(), json.dumps(payload), time.time()),
+            )
+
+    def obtener_detalle(self, codigo: str, estado_listado: str = "") -> dict | None:
+        with self._lock:
+            fila = self._conn.execute(
+                "SELECT estado, payload, guardado FROM detalle WHERE codigo = ?", (codigo,)
+            ).fetchone()
+        if fila is None:
+            return None
+        estado, payload, guardado = fila
+        if estado not in ESTADOS_TERMINALES:
+            if estado_listado and estado_listado != estado:
+                return None
+            if time.time() - guardado >= self.ttl_detalle:
+                return None
+        return json.loads(payload)
+
+    def guardar_detalle(self, codigo: str, oc: dict):
+        organismo = normalizar_texto(safe_get(oc, "Comprador", "CodigoOrganismo"))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO detalle (codigo, estado, payload, guardado) VALUES (?, ?, ?, ?)",
+                (codigo, normalizar_estado(oc.get("CodigoEstado")), json.dumps(oc), time.time()),
+            )
+            if organismo:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO prefijos (prefijo, organismo) VALUES (?, ?)",
+                    (prefijo_codigo(codigo), organismo),
+                )
+
+    def organismos_por_prefijo(self) -> dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT prefijo, organismo FROM prefijos").fetchall())
+
+    def listados_guardados(self, dimension: str, limite: int = 30) -> list[dict]:
+        # Las claves ordenan los parámetros alfabéticamente, así que el primero identifica la dimensión.
+        prefijo = {"organismo": "CodigoOrganismo=", "proveedor": "CodigoProveedor="}.get(dimension, "fecha=")
+        with self._lock:
+            filas = self._conn.execute(
+                "SELECT payload FROM listado WHERE clave LIKE ? ORDER BY fecha DESC LIMIT ?", (prefijo + "%", limite)
+            ).fetchall()
+        return [json.loads(fila[0]) for fila in filas]
+
+    def listados_por_clave(self, dimension: str, limite: int = 1000) -> dict[str, list[dict]]:
+        parametro = PlanConsulta.PARAMETROS.get(dimension)
+        prefijo = f"{parametro}=" if parametro else "fecha="
+        with self._lock:
+            filas = self._conn.execute(
+                "SELECT clave, payload FROM listado WHERE clave LIKE ? ORDER BY fecha DESC LIMIT ?",
+                (prefijo + "%", limite),
+            ).fetchall()
+        por_clave: dict[str, list[dict]] = {}
+        for clave, payload in filas:
+            valores = dict(parte.split("=", 1) for parte in clave.split("&"))
+            por_clave.setdefault(valores.get(parametro, "*"), []).append(json.loads(payload))
+        return por_clave
+
+    def latencias(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT endpoint, promedio FROM latencia").fetchall())
+
+    def guardar_latencias(self, observadas: dict[str, list[float]]):
+        # Promedio acumulado con un tope de muestras para que las ejecuciones recientes sigan pesando.
+        with self._lock, self._conn:
+            for endpoint, muestras in observadas.items():
+                if not muestras:
+                    continue
+                fila = self._conn.execute(
+                    "SELECT muestras, promedio FROM latencia WHERE endpoint = ?", (endpoint,)
+                ).fetchone()
+                previas, promedio = fila if fila else (0, 0.0)
+                previas = min(previas, 1000)
+                total = previas + len(muestras)
+                promedio = (previas * promedio + sum(muestras)) / total
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO latencia (endpoint, muestras, promedio) VALUES (?, ?, ?)",
+                    (endpoint, total, promedio),
+                )
 
-def _close_thread_sessions():
-    with _SESSIONS_LOCK:
-        while _SESSIONS:
-            session = _SESSIONS.pop()
-            session.close()
+    def cerrar(self):
+        with self._lock:
+            self._conn.close()
+
+
+def abrir_cache(args, logger: logging.Logger) -> CacheApi | None:
+    if args.sin_cache:
+        return None
+    try:
+        return CacheApi(Path(args.cache), args.cache_dias_inmutable, args.cache_ttl, args.cache_ttl_detalle)
+    except sqlite3.Error as exc:
+        logger.warning("No se pudo abrir la caché %s (%s); se continúa sin caché", args.cache, exc)
+        return None
+
+
+class Bitacora:
+    def __init__(self, ruta: Path, firma: dict, reanudar: bool, logger: logging.Logger):
+        self.ruta = ruta
+        self.listados: dict[str, list[tuple[str, str]]] = {}
+        self.detalles: set[str] = set()
+        self._lock = Lock()
+        if reanudar and ruta.exists():
+            self._cargar(firma, logger)
+            incompleta = False
+            if ruta.stat().st_size > 0:
+                with ruta.open("rb") as archivo:
+                    archivo.seek(-1, os.SEEK_END)
+                    incompleta = archivo.read(1) != b"\n"
+            self._archivo = ruta.open("a", encoding="utf-8")
+            if incompleta:
+                self._archivo.write("\n")
+        else:
+            self._archivo = ruta.open("w", encoding="utf-8")
+            self._escribir({"tipo": "inicio", "firma": firma})
+
+    def _cargar(self, firma: dict, logger: logging.Logger):
+        with self.ruta.open(encoding="utf-8") as archivo:
+            for numero, linea in enumerate(archivo, start=1):
+                try:
+                    entrada = json.loads(linea)
+                except ValueError:
+                    # Una línea incompleta solo puede quedar al final tras una caída; se descarta.
+                    logger.warning("Línea %s de %s incompleta; se ignora", numero, self.ruta)
+                    continue
+                tipo = entrada.get("tipo")
+                if tipo == "inicio" and entrada.get("firma") != firma:
+                    raise ValueError(
+                        f"La bitácora {self.ruta} corresponde a otra consulta; ejecute sin --resume para comenzar de nuevo"
+                    )
+                if tipo == "listado":
+                    self.listados[entrada["clave"]] = [tuple(par) for par in entrada["codigos"]]
+                elif tipo == "detalle":
+                    self.detalles.update(entrada["codigos"])
+        logger.info(
+            "Reanudando: %s consultas de listado y %s detalles ya completados",
+            len(self.listados),
+            len(self.detalles),
+        )
+
+    def _escribir(self, entrada: dict):
+        self._archivo.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+        self._archivo.flush()
+        os.fsync(self._archivo.fileno())
+
+    def registrar_listado(self, clave: str, codigos: list[tuple[str, str]]):
+        with self._lock:
+            self.listados[clave] = codigos
+            self._escribir({"tipo": "listado", "clave": clave, "codigos": codigos})
+
+    def registrar_detalles(self, codigos: list[str]):
+        if not codigos:
+            return
+        with self._lock:
+            self.detalles.update(codigos)
+            self._escribir({"tipo": "detalle", "codigos": codigos})
+
+    def cerrar(self):
+        with self._lock:
+            self._archivo.close()
+
+
+class MarcasSincronizacion:
+    def __init__(self, ruta: Path):
+        self.ruta = ruta
+        self.marcas: dict[str, date] = {}
+        if ruta.exists():
+            datos = json.loads(ruta.read_text(encoding="utf-8"))
+            self.marcas = {clave: date.fromisoformat(valor) for clave, valor in datos.items()}
+
+    def obtener(self, clave: str) -> date | None:
+        return self.marcas.get(clave)
+
+    def actualizar(self, nuevas: dict[str, date]):
+        cambios = {clave: dia for clave, dia in nuevas.items() if clave not in self.marcas or dia > self.marcas[clave]}
+        if not cambios:
+            return
+        self.marcas.update(cambios)
+        temporal = self.ruta.with_name(self.ruta.name + ".tmp")
+        temporal.write_text(
+            json.dumps({clave: dia.isoformat() for clave, dia in sorted(self.marcas.items())}, indent=2),
+            encoding="utf-8",
+        )
+        os.replace(temporal, self.ruta)
+
+
+def clave_marca(organismo: str, proveedores) -> str:
+    # La marca de un organismo solo vale para el mismo filtro de proveedores con que se sincronizó.
+    return organismo if not proveedores else f"{organismo}|{','.join(sorted(proveedores))}"
+
+
+def inicios_incrementales(organismos, proveedores, args, marcas: MarcasSincronizacion) -> dict[str, date]:
+    inicios: dict[str, date] = {}
+    sin_marca = []
+    for organismo in organismos if organismos is not None else ["*"]:
+        marca = marcas.obtener(clave_marca(organismo, proveedores))
+        if marca is None:
+            if args.desde is None:
+                sin_marca.append(organismo)
+                continue
+            inicio = args.desde
+        else:
+            # Se vuelven a listar los últimos días ya sincronizados porque sus órdenes aún pueden cambiar de estado.
+            inicio = marca + timedelta(days=1 - args.dias_revision)
+            if args.desde is not None:
+                inicio = max(inicio, args.desde)
+        if inicio <= args.hasta:
+            inicios[organismo] = inicio
+    if sin_marca:
+        raise ValueError(
+            f"No hay marca de sincronización para {', '.join(sin_marca)}; indique --desde para la primera ejecución"
+        )
+    return inicios
+
+
+def dias_sincronizados(plan: PlanConsulta, hasta_dt: date, bitacora: Bitacora) -> dict[str, date]:
+    # Último día, contando sin saltos desde su inicio, con todas las consultas de listado del organismo
+    # registradas en la bitácora. El día en curso nunca se marca: sus órdenes siguen apareciendo.
+    limite = min(hasta_dt, hoy_api() - timedelta(days=1))
+    resultado: dict[str, date] = {}
+    for organismo, inicio in plan.inicios.items():
+        claves = [organismo] if plan.dimension == "organismo" else plan.claves()
+        for dia in rango_fechas(inicio, limite):
+            if any(clave_consulta(plan.params(dia, clave)) not in bitacora.listados for clave in claves):
+                break
+            resultado[organismo] = dia
+    return resultado
 
 
 def parse_fecha_arg(valor: str) -> date:
@@ -117,6 +1417,31 @@ def parse_fecha_arg(valor: str) -> date:
         raise argparse.ArgumentTypeError(f"Formato de fecha inválido: {valor}") from exc
 
 
+def parse_shard(valor: str) -> tuple[int, int]:
+    try:
+        indice, total = (int(parte) for parte in valor.split("/"))
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"Formato de fragmento inválido (use i/n, por ejemplo 2/4): {valor}") from exc
+    if not 1 <= indice <= total:
+        raise argparse.ArgumentTypeError(f"El fragmento debe cumplir 1 <= i <= n: {valor}")
+    return indice, total
+
+
+def en_fragmento(clave: str, fragmento: tuple[int, int]) -> bool:
+    # Hash estable (no el hash() de Python, que cambia entre procesos) para que todos los nodos coincidan.
+    indice, total = fragmento
+    return int(hashlib.sha256(clave.encode("utf-8")).hexdigest()[:16], 16) % total == indice - 1
+
+
+def ruta_salida(args, nombre: str) -> Path:
+    # Cada nodo de --shard escribe sus propios archivos, p. ej. consulta_api.shard2de4.csv.
+    ruta = Path(nombre)
+    if getattr(args, "shard", None) is None:
+        return ruta
+    indice, total = args.shard
+    return ruta.with_name(f"{ruta.stem}.shard{indice}de{total}{ruta.suffix}")
+
+
 def parse_ticket(valor: str) -> str:
     token = valor.strip()
     if not token:
@@ -124,6 +1449,22 @@ def parse_ticket(valor: str) -> str:
     return token
 
 
+def parse_codigo(valor: str) -> str:
+    codigo = valor.strip()
+    if not codigo:
+        raise argparse.ArgumentTypeError("El código de organismo o proveedor no puede estar vacío")
+    return codigo
+
+
+def leer_tickets(ruta: Path) -> list[str]:
+    tickets = []
+    for linea in ruta.read_text(encoding="utf-8").splitlines():
+        linea = linea.strip()
+        if linea and not linea.startswith("#"):
+            tickets.append(linea)
+    return tickets
+
+
 def parse_workers(valor: str) -> int:
     try:
         workers = int(valor)
@@ -246,128 +1587,690 @@ def configurar_logger() -> logging.Logger:
     return logger
 
 
-def request_with_retries(
+RESULTADO_OK = "ok"
+RESULTADO_ERROR = "error"
+RESULTADO_REINTENTAR = "reintentar"
+RESULTADO_SATURACION = "saturacion"
+RESULTADO_AUTENTICACION = "autenticacion"
+RESULTADO_CUOTA = "cuota"
+RESULTADOS_REINTENTABLES = {RESULTADO_REINTENTAR, RESULTADO_SATURACION}
+
+
+def clasificar_payload(payload) -> str | None:
+    # La API puede responder HTTP 200 con {"Codigo": ..., "Mensaje": ...} en lugar de un Listado.
+    if not isinstance(payload, dict) or "Listado" in payload:
+        return None
+    if "Codigo" not in payload and "Mensaje" not in payload:
+        return None
+    try:
+        codigo = int(payload.get("Codigo"))
+    except (TypeError, ValueError):
+        codigo = None
+    mensaje = str(payload.get("Mensaje") or "").lower()
+    if codigo in CODIGOS_ERROR_SATURACION or "simult" in mensaje:
+        return "saturacion"
+    if "cuota" in mensaje or "limite diario" in mensaje or "límite diario" in mensaje:
+        return "cuota"
+    if "ticket" in mensaje:
+        return "autenticacion"
+    return "error_api"
+
+
+def leer_retry_after(headers) -> float | None:
+    valor = headers.get("Retry-After") if headers else None
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        instante = parsedate_to_datetime(valor)
+    except (TypeError, ValueError):
+        return None
+    if instante.tzinfo is None:
+        instante = instante.replace(tzinfo=timezone.utc)
+    return max(0.0, (instante - datetime.now(timezone.utc)).total_seconds())
+
+
+def evaluar_respuesta(status: int, payload, params: dict, attempt: int, wait: float, logger: logging.Logger) -> str:
+    registrar_metrica("peticiones")
+    if status == 200:
+        if payload is None:  # pragma: no cover
+            registrar_metrica("respuestas_no_json")
+            logger.error("Respuesta no es JSON para params %s", params)
+            return RESULTADO_ERROR
+        error = clasificar_payload(payload)
+        if error is None:
+            return RESULTADO_OK
+        registrar_metrica(f"errores_en_cuerpo_{error}")
+        if error == "autenticacion":
+            logger.error("La API rechazó el ticket (%s: %s)", payload.get("Codigo"), payload.get("Mensaje"))
+            return RESULTADO_AUTENTICACION
+        if error == "cuota":
+            logger.error("Cuota diaria agotada para el ticket (%s: %s)", payload.get("Codigo"), payload.get("Mensaje"))
+            return RESULTADO_CUOTA
+        logger.warning(
+            "Error en el cuerpo de la respuesta (%s: %s) para params %s (intento %s). Reintentando en %.1fs",
+            payload.get("Codigo"),
+            payload.get("Mensaje"),
+            params,
+            attempt,
+            wait,
+        )
+        return RESULTADO_SATURACION if error == "saturacion" else RESULTADO_REINTENTAR
+    registrar_metrica(f"respuestas_{status}")
+    if status in {401, 403}:
+        logger.error("La API rechazó el ticket con estado %s", status)
+        return RESULTADO_AUTENTICACION
+    if status in {429} or 500 <= status < 600:
+        logger.warning(
+            "Respuesta %s para params %s (intento %s). Reintentando en %.1fs",
+            status,
+            params,
+            attempt,
+            wait,
+        )
+        return RESULTADO_SATURACION if status == 429 else RESULTADO_REINTENTAR
+    logger.error("Error %s para params %s", status, params)
+    return RESULTADO_ERROR
+
+
+def registrar_excepcion(exc: Exception, params: dict, attempt: int, wait: float, logger: logging.Logger) -> str:
+    registrar_metrica("peticiones")
+    registrar_metrica("excepciones")
+    if isinstance(exc, ERRORES_TIEMPO):
+        registrar_metrica("tiempos_agotados")
+    logger.warning(
+        "Excepción en request (%s) para params %s (intento %s). Reintentando en %.1fs",
+        exc or type(exc).__name__,
+        params,
+        attempt,
+        wait,
+    )
+    return RESULTADO_REINTENTAR
+
+
+def _despues_de_peticion(
+    resultado: str,
+    latencia: float,
+    es_sonda: bool,
+    retry_after: float | None,
+    ticket: EstadoTicket | None,
+    endpoint: str,
+):
+    if resultado == RESULTADO_OK:
+        registrar_latencia(endpoint, latencia)
+    if _CONCURRENCIA is not None:
+        _CONCURRENCIA.liberar(resultado, latencia)
+    if _CIRCUITO is not None:
+        _CIRCUITO.registrar(resultado, es_sonda, retry_after)
+    if _POOL is not None and ticket is not None:
+        _POOL.registrar(ticket, resultado, retry_after)
+
+
+def _espera_reintento(wait: float, retry_after: float | None, ticket: EstadoTicket | None = None) -> float:
+    # Con Retry-After se espera lo que indica la API, sin sumar el backoff propio. Lo que ya imponen el
+    # circuito abierto o el bloqueo del ticket se espera al pedir turno, así que aquí no se duerme dos veces.
+    espera = retry_after if retry_after is not None else wait
+    cubierto = _CIRCUITO.espera_pendiente() if _CIRCUITO is not None else 0.0
+    if ticket is not None:
+        cubierto = max(cubierto, ticket.bloqueado_hasta - time.monotonic())
+    return max(0.0, espera - cubierto)
+
+
+def _cambiar_de_ticket(resultado: str, ticket: EstadoTicket | None) -> bool:
+    # Un ticket rechazado, sin cuota o saturado se reemplaza de inmediato por otro, sin esperar el backoff.
+    if resultado in (RESULTADO_AUTENTICACION, RESULTADO_CUOTA):
+        return True
+    return resultado == RESULTADO_SATURACION and _POOL is not None and _POOL.hay_alternativa(ticket)
+
+
+def _request_with_retries(
     session: requests.Session,
     params: dict,
     read_timeout: float,
     retries: int,
     logger: logging.Logger,
+    diferir_tras: int | None = None,
 ):
     attempt = 0
     wait = 1.0
     max_wait = 60.0
     ilimitado = retries <= 0
+    endpoint = endpoint_de(params)
     while True:
         attempt += 1
+        # El lugar de concurrencia se toma antes del turno del circuito y del ticket: así la reserva del
+        # limitador no se hace con una petición que después queda esperando su lugar.
+        if _CONCURRENCIA is not None:
+            _CONCURRENCIA.adquirir()
+        es_sonda = False
         try:
-            response = session.get(BASE_URL, params=params, timeout=(10, read_timeout))
+            es_sonda = _CIRCUITO.esperar_turno() if _CIRCUITO is not None else False
+            ticket = _POOL.adquirir() if _POOL is not None else None
+        except BaseException:
+            if es_sonda:
+                _CIRCUITO.liberar_sonda()
+            if _CONCURRENCIA is not None:
+                _CONCURRENCIA.devolver()
+            raise
+        params_ticket = {**params, "ticket": ticket.ticket} if ticket is not None else params
+        inicio = time.monotonic()
+        resultado = RESULTADO_REINTENTAR
+        payload = None
+        retry_after = None
+        try:
+            timeout = timeout_lectura(endpoint, read_timeout, attempt)
+            response = session.get(BASE_URL, params=params_ticket, timeout=(10, timeout))
             if response.status_code == 200:
-                return response
-            if response.status_code in {429} or 500 <= response.status_code < 600:
-                logger.warning(
-                    "Respuesta %s para params %s (intento %s). Reintentando en %.1fs",
-                    response.status_code,
-                    params,
-                    attempt,
-                    wait,
-                )
-            else:
-                logger.error("Error %s para params %s", response.status_code, params)
-                return None
-        except requests.RequestException as exc:
-            logger.warning(
-                "Excepción en request (%s) para params %s (intento %s). Reintentando en %.1fs",
-                exc,
-                params,
-                attempt,
-                wait,
+                try:
+                    payload = response.json()
+                except ValueError:  # pragma: no cover
+                    payload = None
+            retry_after = leer_retry_after(response.headers)
+            resultado = evaluar_respuesta(
+                response.status_code, payload, params, attempt, retry_after if retry_after is not None else wait, logger
             )
+        except ERRORES_HTTP as exc:
+            resultado = registrar_excepcion(exc, params, attempt, wait, logger)
+        finally:
+            _despues_de_peticion(resultado, time.monotonic() - inicio, es_sonda, retry_after, ticket, endpoint)
 
-        if not ilimitado and attempt >= retries:
+        if resultado == RESULTADO_OK:
+            return payload
+        if resultado == RESULTADO_ERROR:
+            return None
+        if _cambiar_de_ticket(resultado, ticket):
+            continue
+        agotados = not ilimitado and attempt >= retries
+        if diferir_tras and (agotados or attempt >= diferir_tras):
+            # En lugar de seguir durmiendo en este trabajador (o de perder la petición al agotar --retries),
+            # el llamador la aparta para más tarde.
+            registrar_metrica("peticiones_diferidas")
+            logger.warning("Se difiere la petición con params %s tras %s intentos", params, attempt)
+            raise PeticionDiferida(attempt)
+        if agotados:
             logger.error("Agotados los reintentos para params %s", params)
             return None
 
-        time.sleep(wait)
-        wait = min(wait * 2, max_wait)
+        time.sleep(_espera_reintento(wait, retry_after, ticket))
+        if retry_after is None:
+            wait = min(wait * 2, max_wait)
 
 
-def listar_oc_por_rango(ticket, organismos, desde_dt, hasta_dt, args, logger):
-    codigos: list[str] = []
-    vistos = set()
-    fechas = list(rango_fechas(desde_dt, hasta_dt))
-    combinaciones = [(dia, org) for dia in fechas for org in organismos]
-    total = len(combinaciones)
-
-    if args.workers <= 1:
-        session = requests.Session()
+async def _request_with_retries_async(
+    session,
+    params: dict,
+    read_timeout: float,
+    retries: int,
+    logger: logging.Logger,
+    diferir_tras: int | None = None,
+):
+    attempt = 0
+    wait = 1.0
+    max_wait = 60.0
+    ilimitado = retries <= 0
+    endpoint = endpoint_de(params)
+    while True:
+        attempt += 1
+        if _CONCURRENCIA is not None:
+            await _CONCURRENCIA.adquirir_async()
+        es_sonda = False
         try:
-            if tqdm:
-                iterable = tqdm(combinaciones, total=total, desc="Listando", unit="consulta")
-            else:
-                iterable = combinaciones
-            for idx, (dia, organismo) in enumerate(iterable, start=1):
-                params = {"fecha": to_api_date(dia), "CodigoOrganismo": organismo, "ticket": ticket}
-                response = request_with_retries(session, params, args.timeout, args.retries, logger)
-                if response is None:
-                    continue
-                try:
-                    payload = response.json()
-                except ValueError:  # pragma: no cover
-                    logger.error("Respuesta no es JSON para params %s", params)
-                    continue
-                listado = payload.get("Listado") or []
-                for registro in listado:
-                    codigo = registro.get("Codigo") or registro.get("codigo")
-                    if codigo and codigo not in vistos:
-                        vistos.add(codigo)
-                        codigos.append(codigo)
-                if not tqdm and idx % args.progress_every == 0:
-                    logger.info("Procesados %s de %s combinaciones", idx, total)
-                time.sleep(args.sleep)
-            return codigos
+            es_sonda = await _CIRCUITO.esperar_turno_async() if _CIRCUITO is not None else False
+            ticket = await _POOL.adquirir_async() if _POOL is not None else None
+        except BaseException:
+            if es_sonda:
+                _CIRCUITO.liberar_sonda()
+            if _CONCURRENCIA is not None:
+                _CONCURRENCIA.devolver()
+            raise
+        params_ticket = {**params, "ticket": ticket.ticket} if ticket is not None else params
+        inicio = time.monotonic()
+        resultado = RESULTADO_REINTENTAR
+        payload = None
+        retry_after = None
+        try:
+            timeout = aiohttp.ClientTimeout(
+                total=None, sock_connect=10, sock_read=timeout_lectura(endpoint, read_timeout, attempt)
+            )
+            async with session.get(BASE_URL, params=params_ticket, timeout=timeout) as response:
+                if response.status == 200:
+                    try:
+                        payload = await response.json(content_type=None)
+                    except ValueError:  # pragma: no cover
+                        payload = None
+                retry_after = leer_retry_after(response.headers)
+                resultado = evaluar_respuesta(
+                    response.status, payload, params, attempt, retry_after if retry_after is not None else wait, logger
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            resultado = registrar_excepcion(exc, params, attempt, wait, logger)
         finally:
-            session.close()
+            _despues_de_peticion(resultado, time.monotonic() - inicio, es_sonda, retry_after, ticket, endpoint)
+
+        if resultado == RESULTADO_OK:
+            return payload
+        if resultado == RESULTADO_ERROR:
+            return None
+        if _cambiar_de_ticket(resultado, ticket):
+            continue
+        agotados = not ilimitado and attempt >= retries
+        if diferir_tras and (agotados or attempt >= diferir_tras):
+            # En lugar de seguir durmiendo en este trabajador (o de perder la petición al agotar --retries),
+            # el llamador la aparta para más tarde.
+            registrar_metrica("peticiones_diferidas")
+            logger.warning("Se difiere la petición con params %s tras %s intentos", params, attempt)
+            raise PeticionDiferida(attempt)
+        if agotados:
+            logger.error("Agotados los reintentos para params %s", params)
+            return None
+
+        await asyncio.sleep(_espera_reintento(wait, retry_after, ticket))
+        if retry_after is None:
+            wait = min(wait * 2, max_wait)
 
-    lock = Lock()
 
-    def procesar(dia: date, organismo: str) -> list[str]:
-        session = _get_thread_session()
-        params = {"fecha": to_api_date(dia), "CodigoOrganismo": organismo, "ticket": ticket}
-        response = request_with_retries(session, params, args.timeout, args.retries, logger)
-        resultados: list[str] = []
-        if response is not None:
+class VueloCompartido:
+    def __init__(self):
+        self.listo = Event()
+        self.resultado = None
+        self.error: BaseException | None = None
+
+
+_VUELOS: dict[tuple, VueloCompartido] = {}
+_VUELOS_LOCK = Lock()
+_VUELOS_ASYNC: dict[tuple, asyncio.Future] = {}
+
+
+def clave_vuelo(params: dict) -> tuple:
+    # El ticket se agrega recién al enviar, así que dos pedidos iguales comparten clave con cualquier ticket.
+    return endpoint_de(params), tuple(sorted((k, str(v)) for k, v in params.items() if k != "ticket"))
+
+
+def request_with_retries(
+    session: requests.Session,
+    params: dict,
+    read_timeout: float,
+    retries: int,
+    logger: logging.Logger,
+    diferir_tras: int | None = None,
+):
+    # Pedidos idénticos simultáneos comparten una sola llamada a la red y el mismo payload (de solo lectura).
+    clave = clave_vuelo(params)
+    with _VUELOS_LOCK:
+        vuelo = _VUELOS.get(clave)
+        lider = vuelo is None
+        if lider:
+            vuelo = _VUELOS[clave] = VueloCompartido()
+    if not lider:
+        registrar_metrica("peticiones_compartidas")
+        vuelo.listo.wait()
+        if vuelo.error is not None:
+            raise vuelo.error
+        return vuelo.resultado
+    try:
+        vuelo.resultado = _request_with_retries(session, params, read_timeout, retries, logger, diferir_tras)
+        return vuelo.resultado
+    except BaseException as exc:
+        vuelo.error = exc
+        raise
+    finally:
+        with _VUELOS_LOCK:
+            del _VUELOS[clave]
+        vuelo.listo.set()
+
+
+async def request_with_retries_async(
+    session,
+    params: dict,
+    read_timeout: float,
+    retries: int,
+    logger: logging.Logger,
+    diferir_tras: int | None = None,
+):
+    clave = clave_vuelo(params)
+    vuelo = _VUELOS_ASYNC.get(clave)
+    if vuelo is not None:
+        registrar_metrica("peticiones_compartidas")
+        return await asyncio.shield(vuelo)
+    vuelo = _VUELOS_ASYNC[clave] = asyncio.get_running_loop().create_future()
+    try:
+        resultado = await _request_with_retries_async(session, params, read_timeout, retries, logger, diferir_tras)
+        vuelo.set_result(resultado)
+        return resultado
+    except asyncio.CancelledError:
+        vuelo.cancel()
+        raise
+    except BaseException as exc:
+        vuelo.set_exception(exc)
+        # Marca la excepción como leída aunque ningún otro pedido espere este vuelo.
+        vuelo.exception()
+        raise
+    finally:
+        del _VUELOS_ASYNC[clave]
+
+
+def max_en_vuelo(args) -> int:
+    return args.max_en_vuelo or 2 * args.workers
+
+
+def ejecutar_acotado(executor: ThreadPoolExecutor, procesar, tareas, limite: int):
+    # Entrega (clave, future) a medida que terminan, con a lo sumo `limite` tareas enviadas a la vez.
+    # Como es un generador, no se envía trabajo nuevo mientras quien consume (el escritor) esté ocupado.
+    iterador = iter(tareas)
+    pendientes = {}
+    agotado = False
+    while True:
+        while not agotado and len(pendientes) < limite:
             try:
-                payload = response.json()
-            except ValueError:  # pragma: no cover
-                logger.error("Respuesta no es JSON para params %s", params)
-            else:
-                listado = payload.get("Listado") or []
-                for registro in listado:
-                    codigo = registro.get("Codigo") or registro.get("codigo")
-                    if codigo:
-                        resultados.append(codigo)
-        time.sleep(args.sleep)
-        return resultados
+                clave, argumentos = next(iterador)
+            except StopIteration:
+                agotado = True
+                break
+            pendientes[executor.submit(procesar, *argumentos)] = clave
+        if not pendientes:
+            return
+        hechos, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+        for future in hechos:
+            yield pendientes.pop(future), future
+
+
+def _traza_aiohttp():
+    traza = aiohttp.TraceConfig()
+
+    async def inicio(session, contexto, params):
+        contexto.inicio_conexion = time.monotonic()
+
+    async def fin(session, contexto, params):
+        _registrar_conexion(contexto.inicio_conexion)
+
+    traza.on_connection_create_start.append(inicio)
+    traza.on_connection_create_end.append(fin)
+    return traza
+
+
+async def ejecutar_async(items, procesar, concurrencia: int):
+    # Un conjunto fijo de corrutinas consume el iterador compartido, de modo que la memoria no crece con los ítems.
+    iterador = iter(items)
+    # Los duplicados de --hedge y las copias perdedoras que siguen en curso necesitan conexiones propias.
+    limite = 2 * concurrencia if _COBERTURA is not None else concurrencia
+    conector = aiohttp.TCPConnector(limit=limite, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=conector, trace_configs=[_traza_aiohttp()]) as session:
+
+        async def trabajador():
+            for item in iterador:
+                await procesar(session, item)
+
+        await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+
+
+def obtener_listado(session, dia: date, params: dict, args, logger, cache: CacheApi | None, diferir_tras=None):
+    if cache is not None:
+        payload = cache.obtener_listado(dia, params)
+        if payload is not None and not listado_incompleto(payload):
+            return payload, True
+    try:
+        payload = request_with_retries(session, params, args.timeout, args.retries, logger, diferir_tras)
+    except PeticionDiferida:
+        # La combinación queda como fallida y se vuelve a consultar en la verificación del listado.
+        return None, False
+    if payload is not None and cache is not None and not listado_incompleto(payload):
+        cache.guardar_listado(dia, params, payload)
+    return payload, False
+
+
+async def obtener_listado_async(
+    session, dia: date, params: dict, args, logger, cache: CacheApi | None, diferir_tras=None
+):
+    if cache is not None:
+        payload = cache.obtener_listado(dia, params)
+        if payload is not None and not listado_incompleto(payload):
+            return payload, True
+    try:
+        payload = await request_with_retries_async(session, params, args.timeout, args.retries, logger, diferir_tras)
+    except PeticionDiferida:
+        return None, False
+    if payload is not None and cache is not None and not listado_incompleto(payload):
+        cache.guardar_listado(dia, params, payload)
+    return payload, False
+
+
+def pausa_listado(args) -> float:
+    # Con --rate el ritmo lo fija el limitador global y los trabajadores no duermen por su cuenta.
+    return 0.0 if args.tasa else args.sleep
+
+
+def normalizar_estado(valor) -> str:
+    return "" if valor is None else str(valor).strip()
+
+
+def listado_incompleto(payload: dict) -> bool:
+    # Cantidad informa el total de órdenes de la consulta; si no coincide con el Listado, la respuesta vino recortada.
+    try:
+        cantidad = int(payload.get("Cantidad"))
+    except (TypeError, ValueError):
+        return False
+    return cantidad != len(payload.get("Listado") or [])
+
+
+def extraer_codigos(
+    payload: dict, plan: PlanConsulta | None = None, prefiltro: PrefiltroFechas | None = None
+) -> list[tuple[str, str]]:
+    codigos: list[tuple[str, str]] = []
+    for registro in payload.get("Listado") or []:
+        codigo = registro.get("Codigo") or registro.get("codigo")
+        # El filtro del plan va primero: un código que el plan descarta no cuenta como descarga evitada.
+        if not codigo or (plan is not None and not plan.admite_registro(registro, codigo)):
+            continue
+        if prefiltro is None or not prefiltro.descarta(registro, codigo):
+            codigos.append((codigo, normalizar_estado(registro.get("CodigoEstado"))))
+    return codigos
+
+
+def informar_listado(logger, aciertos_cache: int, total: int, prefiltro: PrefiltroFechas):
+    logger.info("Consultas de listado servidas desde caché: %s de %s", aciertos_cache, total)
+    evitados = prefiltro.evitados()
+    if evitados:
+        registrar_metrica("detalles_evitados_prefiltro", evitados)
+        logger.info("Prefiltro por fecha: %s descargas de detalle evitadas", evitados)
+
+
+def listar_oc_por_rango(
+    organismos,
+    desde_dt,
+    hasta_dt,
+    args,
+    logger,
+    cache: CacheApi | None = None,
+    bitacora: Bitacora | None = None,
+    al_descubrir=None,
+    plan: PlanConsulta | None = None,
+    modo_prefiltro: str | None = None,
+):
+    codigos: dict[str, str] = {}
+    vistos = set()
+    aciertos_cache = 0
+    plan = plan or PlanConsulta("organismo", organismos)
+    prefiltro = PrefiltroFechas(modo_prefiltro or args.prefiltro, piso_creacion(args, desde_dt), hasta_dt, cache)
+
+    def todas_las_combinaciones():
+        for dia in rango_fechas(desde_dt, hasta_dt):
+            for clave in plan.claves_del_dia(dia):
+                yield dia, clave, plan.params(dia, clave)
+
+    def ya_listada(params: dict) -> bool:
+        return bitacora is not None and clave_consulta(params) in bitacora.listados
+
+    # Las combinaciones se generan bajo demanda para que un rango largo no ocupe memoria proporcional.
+    def combinaciones():
+        return (combinacion for combinacion in todas_las_combinaciones() if not ya_listada(combinacion[2]))
+
+    total = 0
+    for _, _, params in todas_las_combinaciones():
+        if not ya_listada(params):
+            total += 1
+            continue
+        for codigo, estado in bitacora.listados[clave_consulta(params)]:
+            if codigo not in vistos:
+                vistos.add(codigo)
+                codigos[codigo] = estado
+                if al_descubrir is not None:
+                    al_descubrir(codigo, estado)
+
+    def registrar(params: dict, nuevos: list[tuple[str, str]], definitivo: bool = True):
+        if bitacora is not None and definitivo:
+            bitacora.registrar_listado(clave_consulta(params), nuevos)
+        for codigo, estado in nuevos:
+            if codigo not in vistos:
+                vistos.add(codigo)
+                codigos[codigo] = estado
+                if al_descubrir is not None:
+                    al_descubrir(codigo, estado)
+
+    # Consultas fallidas o con Cantidad distinta del largo del Listado; se repiten al final del listado.
+    pendientes: list[tuple[date, str, dict]] = []
+    parciales: dict[str, list[tuple[str, str]]] = {}
+
+    def recibir(dia: date, clave: str, params: dict, nuevos: list[tuple[str, str]] | None, incompleto: bool):
+        if nuevos is None:
+            registrar_metrica("listados_fallidos")
+            pendientes.append((dia, clave, params))
+        elif incompleto:
+            # Los códigos recibidos se usan de inmediato, pero la consulta no se da por completa en la bitácora.
+            registrar_metrica("listados_incompletos")
+            registrar(params, nuevos, definitivo=False)
+            parciales[clave_consulta(params)] = nuevos
+            pendientes.append((dia, clave, params))
+        else:
+            registrar(params, nuevos)
+
+    def verificar():
+        if not pendientes:
+            return
+        logger.warning(
+            "Verificación del listado: %s consultas fallidas o incompletas; se vuelven a consultar", len(pendientes)
+        )
+        sin_completar = []
+        session = sesion_http()
+        for dia, clave, params in pendientes:
+            try:
+                # Con --diferir-tras una combinación que sigue fallando queda sin completar en lugar de
+                # reintentarse sin fin (con --retries 0 los reintentos son ilimitados).
+                payload, desde_cache = obtener_listado(session, dia, params, args, logger, cache, args.diferir_tras)
+            except ErrorFatalApi:
+                raise
+            except Exception as exc:  # pragma: no cover
+                logger.exception("Error listando combinación (%s, %s): %s", dia, clave, exc)
+                payload, desde_cache = None, False
+            if payload is None:
+                sin_completar.append(f"{dia.isoformat()} {clave}")
+                continue
+            if listado_incompleto(payload):
+                # Si la API repite la misma respuesta, se acepta para no repetir la consulta indefinidamente.
+                registrar_metrica("listados_inconsistentes")
+                logger.warning(
+                    "La consulta (%s, %s) sigue informando Cantidad=%s con %s órdenes; se acepta",
+                    dia,
+                    clave,
+                    payload.get("Cantidad"),
+                    len(payload.get("Listado") or []),
+                )
+            nuevos = parciales.pop(clave_consulta(params), []) + extraer_codigos(payload, plan, prefiltro)
+            registrar(params, list(dict.fromkeys(nuevos)))
+            if not desde_cache:
+                time.sleep(pausa_listado(args))
+        if sin_completar:
+            registrar_metrica("listados_sin_completar", len(sin_completar))
+            logger.error("Consultas de listado sin completar tras la verificación: %s", ", ".join(sin_completar))
+        else:
+            logger.info("Verificación del listado completada: no quedan consultas pendientes")
+
+    if args.motor == "async":
+        progress = tqdm(total=total, desc="Listando", unit="consulta") if tqdm else None
+        completadas = 0
+
+        async def procesar_async(session, combinacion):
+            nonlocal aciertos_cache, completadas
+            dia, organismo, params = combinacion
+            try:
+                payload, desde_cache = await obtener_listado_async(
+                    session, dia, params, args, logger, cache, args.diferir_tras
+                )
+                if not desde_cache:
+                    await asyncio.sleep(pausa_listado(args))
+            except ErrorFatalApi:
+                raise
+            except Exception as exc:  # pragma: no cover
+                logger.exception("Error listando combinación (%s, %s): %s", dia, organismo, exc)
+                payload, desde_cache = None, False
+            if desde_cache:
+                aciertos_cache += 1
+            nuevos = extraer_codigos(payload, plan, prefiltro) if payload is not None else None
+            recibir(dia, organismo, params, nuevos, payload is not None and listado_incompleto(payload))
+            completadas += 1
+            if progress:
+                progress.update(1)
+            elif completadas % args.progress_every == 0:
+                logger.info("Procesados %s de %s combinaciones", completadas, total)
+
+        try:
+            asyncio.run(ejecutar_async(combinaciones(), procesar_async, args.concurrencia))
+        finally:
+            if progress:
+                progress.close()
+        verificar()
+        informar_listado(logger, aciertos_cache, total, prefiltro)
+        return codigos
+
+    if args.workers <= 1:
+        session = sesion_http()
+        if tqdm:
+            iterable = tqdm(combinaciones(), total=total, desc="Listando", unit="consulta")
+        else:
+            iterable = combinaciones()
+        for idx, (dia, organismo, params) in enumerate(iterable, start=1):
+            payload, desde_cache = obtener_listado(session, dia, params, args, logger, cache, args.diferir_tras)
+            if desde_cache:
+                aciertos_cache += 1
+            nuevos = extraer_codigos(payload, plan, prefiltro) if payload is not None else None
+            recibir(dia, organismo, params, nuevos, payload is not None and listado_incompleto(payload))
+            if not tqdm and idx % args.progress_every == 0:
+                logger.info("Procesados %s de %s combinaciones", idx, total)
+            if not desde_cache:
+                time.sleep(pausa_listado(args))
+        verificar()
+        informar_listado(logger, aciertos_cache, total, prefiltro)
+        return codigos
+
+    def procesar(dia: date, params: dict) -> tuple[list[tuple[str, str]] | None, bool, bool]:
+        session = sesion_http()
+        payload, desde_cache = obtener_listado(session, dia, params, args, logger, cache, args.diferir_tras)
+        if not desde_cache:
+            time.sleep(pausa_listado(args))
+        if payload is None:
+            return None, desde_cache, False
+        return extraer_codigos(payload, plan, prefiltro), desde_cache, listado_incompleto(payload)
 
     progress = tqdm(total=total, desc="Listando", unit="consulta") if tqdm else None
     try:
         with ThreadPoolExecutor(max_workers=args.workers) as executor:
-            future_to_combo = {
-                executor.submit(procesar, dia, organismo): (dia, organismo) for dia, organismo in combinaciones
-            }
-            for idx, future in enumerate(as_completed(future_to_combo), start=1):
-                dia, organismo = future_to_combo[future]
+            tareas = ((combinacion, (combinacion[0], combinacion[2])) for combinacion in combinaciones())
+            for idx, ((dia, organismo, params), future) in enumerate(
+                ejecutar_acotado(executor, procesar, tareas, max_en_vuelo(args)), start=1
+            ):
                 try:
-                    nuevos = future.result()
+                    nuevos, desde_cache, incompleto = future.result()
+                except ErrorFatalApi:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
                 except Exception as exc:  # pragma: no cover
                     logger.exception("Error listando combinación (%s, %s): %s", dia, organismo, exc)
-                    nuevos = []
-                if nuevos:
-                    with lock:
-                        for codigo in nuevos:
-                            if codigo not in vistos:
-                                vistos.add(codigo)
-                                codigos.append(codigo)
+                    nuevos, desde_cache, incompleto = None, False, False
+                if desde_cache:
+                    aciertos_cache += 1
+                recibir(dia, organismo, params, nuevos, incompleto)
                 if progress:
                     progress.update(1)
                 elif idx % args.progress_every == 0:
@@ -375,7 +2278,8 @@ def listar_oc_por_rango(ticket, organismos, desde_dt, hasta_dt, args, logger):
     finally:
         if progress:
             progress.close()
-        _close_thread_sessions()
+    verificar()
+    informar_listado(logger, aciertos_cache, total, prefiltro)
     return codigos
 
 
@@ -418,105 +2322,431 @@ def construir_fila_oc(oc: dict) -> dict:
     return fila
 
 
-def descargar_detalle_y_escribir(ticket, codigos, args, desde_dt, hasta_dt, logger):
-    csv_path = Path("consulta_api.csv")
-    escribir_header = True
-    filas_batch = []
-    escritos = 0
+def _gana_cobertura(primaria, secundaria) -> bool:
+    return secundaria.done() and secundaria.exception() is None and secundaria.result() is not None
 
-    if csv_path.exists():
-        csv_path.unlink()
 
-    def flush():
-        nonlocal escribir_header, filas_batch, escritos
-        if not filas_batch:
-            return
-        with csv_path.open("a", newline="", encoding="utf-8") as archivo:
-            writer = csv.DictWriter(archivo, fieldnames=COLUMNAS)
-            if escribir_header:
-                writer.writeheader()
-                escribir_header = False
-            writer.writerows(filas_batch)
-        escritos += len(filas_batch)
-        filas_batch = []
+def _gana_primaria(primaria, secundaria) -> bool:
+    # La respuesta original se usa si fue exitosa o lanzó un error, o si el duplicado ya falló.
+    return primaria.done() and (
+        primaria.exception() is not None or primaria.result() is not None or secundaria.done()
+    )
+
+
+def pedir_detalle(session, params: dict, args, logger, diferir_tras=None):
+    cobertura = _COBERTURA
+    umbral = cobertura.registrar_peticion() if cobertura is not None else None
+    if umbral is None:
+        return request_with_retries(session, params, args.timeout, args.retries, logger, diferir_tras)
+    # Ambas copias corren en hilos propios para que este pueda esperar a la primera que responda.
+    primaria = cobertura.ejecutor.submit(
+        request_with_retries, sesion_http(), params, args.timeout, args.retries, logger, diferir_tras
+    )
+    hechos, _ = wait([primaria], timeout=umbral)
+    if hechos or not cobertura.autorizar():
+        return primaria.result()
+    registrar_metrica("detalles_cubiertos")
+    logger.debug("Detalle %s sin respuesta tras %.1fs; se envía un duplicado", params.get("codigo"), umbral)
+    # El duplicado no pasa por el vuelo compartido: se uniría a la petición lenta que intenta adelantar.
+    secundaria = cobertura.ejecutor.submit(_request_with_retries, sesion_http(), params, args.timeout, 1, logger)
+    pendientes = {primaria, secundaria}
+    while pendientes:
+        _, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+        if _gana_cobertura(primaria, secundaria):
+            registrar_metrica("coberturas_ganadoras")
+            return secundaria.result()
+        if _gana_primaria(primaria, secundaria):
+            return primaria.result()
+    return primaria.result()
+
+
+async def pedir_detalle_async(session, params: dict, args, logger, diferir_tras=None):
+    cobertura = _COBERTURA
+    umbral = cobertura.registrar_peticion() if cobertura is not None else None
+    if umbral is None:
+        return await request_with_retries_async(session, params, args.timeout, args.retries, logger, diferir_tras)
+    primaria = asyncio.ensure_future(
+        request_with_retries_async(session, params, args.timeout, args.retries, logger, diferir_tras)
+    )
+    hechos, _ = await asyncio.wait({primaria}, timeout=umbral)
+    if hechos or not cobertura.autorizar():
+        return await primaria
+    registrar_metrica("detalles_cubiertos")
+    logger.debug("Detalle %s sin respuesta tras %.1fs; se envía un duplicado", params.get("codigo"), umbral)
+    secundaria = asyncio.ensure_future(_request_with_retries_async(session, params, args.timeout, 1, logger))
+    # La copia perdedora no se cancela (contaría como fallo en el circuito); termina sola y se ignora.
+    for tarea in (primaria, secundaria):
+        tarea.add_done_callback(lambda t: t.cancelled() or t.exception())
+    pendientes = {primaria, secundaria}
+    while pendientes:
+        _, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+        if _gana_cobertura(primaria, secundaria):
+            registrar_metrica("coberturas_ganadoras")
+            return secundaria.result()
+        if _gana_primaria(primaria, secundaria):
+            return primaria.result()
+    return primaria.result()
+
+
+def obtener_detalle(
+    session, codigo: str, estado_listado: str, args, logger, cache: CacheApi | None, diferir_tras=None
+):
+    if cache is not None:
+        oc = cache.obtener_detalle(codigo, estado_listado)
+        if oc is not None:
+            return oc, True
+    params = {"codigo": codigo}
+    oc = extraer_oc(pedir_detalle(session, params, args, logger, diferir_tras))
+    if oc is not None and cache is not None:
+        cache.guardar_detalle(codigo, oc)
+    return oc, False
+
+
+async def obtener_detalle_async(
+    session, codigo: str, estado_listado: str, args, logger, cache: CacheApi | None, diferir_tras=None
+):
+    if cache is not None:
+        oc = cache.obtener_detalle(codigo, estado_listado)
+        if oc is not None:
+            return oc, True
+    params = {"codigo": codigo}
+    oc = extraer_oc(await pedir_detalle_async(session, params, args, logger, diferir_tras))
+    if oc is not None and cache is not None:
+        cache.guardar_detalle(codigo, oc)
+    return oc, False
+
+
+def extraer_oc(payload: dict | None) -> dict | None:
+    if payload is None:
+        return None
+    listado = payload.get("Listado") or []
+    if isinstance(listado, dict):
+        listado = [listado]
+    return listado[0] if listado else None
+
+
+def piso_creacion(args, desde_dt: date) -> date:
+    # Con --incremental los días ya sincronizados se vuelven a listar para recoger cambios de estado; esas órdenes
+    # pueden haberse creado antes de la ventana, así que no se descartan por su fecha de creación.
+    return date.min if args.incremental else desde_dt
+
+
+def fila_en_rango(oc: dict | None, desde_dt: date, hasta_dt: date, plan: PlanConsulta | None = None) -> dict | None:
+    if not oc or (plan is not None and not plan.admite_oc(oc)):
+        return None
+    fecha_creacion = parse_fecha_json(safe_get(oc, "Fechas", "FechaCreacion"))
+    if fecha_creacion is None or fecha_creacion < desde_dt or fecha_creacion > hasta_dt:
+        return None
+    return construir_fila_oc(oc)
+
+
+def pausa_detalle(args) -> float:
+    if args.tasa:
+        return 0.0
+    return args.sleep_detail + random.uniform(0, max(args.sleep_detail * 0.1, 0.01))
+
+
+def leer_codigos_csv(csv_path: Path) -> set[str]:
+    with csv_path.open(newline="", encoding="utf-8") as archivo:
+        return {fila["Código OC"] for fila in csv.DictReader(archivo) if fila.get("Código OC")}
+
+
+def leer_estados_csv(csv_path: Path) -> dict[str, str]:
+    # Las filas se agregan en orden, así que la última de cada código tiene su estado más reciente.
+    if not csv_path.exists():
+        return {}
+    with csv_path.open(newline="", encoding="utf-8") as archivo:
+        return {
+            fila["Código OC"]: normalizar_estado(fila.get("Código Estado"))
+            for fila in csv.DictReader(archivo)
+            if fila.get("Código OC")
+        }
+
+
+class EscritorCsv:
+    def __init__(
+        self,
+        csv_path: Path,
+        args,
+        logger: logging.Logger,
+        bitacora: Bitacora | None = None,
+        anexar: bool = False,
+    ):
+        self.csv_path = csv_path
+        self.batch_size = args.batch_size
+        self.bitacora = bitacora
+        self.escritos = 0
+        self.completados: set[str] = set()
+        self.reanudando = False
+        self._logger = logger
+        self._escribir_header = True
+        self._filas: list[dict] = []
+        self._codigos: list[str] = []
+        self.estados: dict[str, str] = {}
+        # Los tramos posteriores de una misma ejecución continúan el CSV igual que una reanudación.
+        continua = args.reanudar or (bitacora is not None and bool(bitacora.detalles))
+        if anexar:
+            # Con --watch cada cambio de estado agrega una fila nueva, aunque el código ya esté en el CSV.
+            self._escribir_header = not (csv_path.exists() and csv_path.stat().st_size > 0)
+        elif args.incremental and csv_path.exists() and csv_path.stat().st_size > 0:
+            # La salida incremental es acumulativa: se agregan las órdenes nuevas y las que cambiaron de estado,
+            # y la última fila de cada código es la vigente, igual que con --watch.
+            self.reanudando = True
+            self._escribir_header = False
+            self.estados = leer_estados_csv(csv_path)
+            if bitacora is not None:
+                self.completados = set(bitacora.detalles)
+        elif continua and csv_path.exists() and csv_path.stat().st_size > 0:
+            self.reanudando = True
+            self._escribir_header = False
+            self.completados = leer_codigos_csv(csv_path)
+            if bitacora is not None:
+                self.completados |= bitacora.detalles
+        elif csv_path.exists():
+            csv_path.unlink()
+
+    def pendientes(self, codigos: dict[str, str]) -> dict[str, str]:
+        if not self.reanudando:
+            return codigos
+        pendientes = {codigo: estado for codigo, estado in codigos.items() if not self.omitir(codigo, estado)}
+        self._logger.info(
+            "Reanudando detalle: %s códigos ya procesados, %s pendientes",
+            len(codigos) - len(pendientes),
+            len(pendientes),
+        )
+        return pendientes
+
+    def omitir(self, codigo: str, estado: str) -> bool:
+        return codigo in self.completados or self.estados.get(codigo) == normalizar_estado(estado)
+
+    def agregar(self, codigo: str, oc: dict | None, fila: dict | None):
+        if oc is not None:
+            self._codigos.append(codigo)
+        if fila:
+            self._filas.append(fila)
+        if len(self._filas) >= self.batch_size or len(self._codigos) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._filas:
+            with self.csv_path.open("a", newline="", encoding="utf-8") as archivo:
+                writer = csv.DictWriter(archivo, fieldnames=COLUMNAS)
+                if self._escribir_header:
+                    writer.writeheader()
+                    self._escribir_header = False
+                writer.writerows(self._filas)
+                archivo.flush()
+                os.fsync(archivo.fileno())
+            self.escritos += len(self._filas)
+        # La bitácora se actualiza después del CSV para que una caída nunca marque filas sin escribir.
+        if self.bitacora is not None:
+            self.bitacora.registrar_detalles(self._codigos)
+        self._filas = []
+        self._codigos = []
+
+
+class ColaDiferidos:
+    # Códigos cuyo detalle falló varias veces seguidas; se apartan para que los trabajadores sigan con otros.
+    def __init__(self):
+        self._lock = Lock()
+        self._items: list[tuple[float, str, str, int]] = []
+
+    def agregar(self, codigo: str, estado: str, intentos: int):
+        with self._lock:
+            self._items.append((time.monotonic() + ESPERA_DIFERIDOS, codigo, estado, intentos))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def extraer_todos(self) -> list[tuple[float, str, str, int]]:
+        with self._lock:
+            items, self._items = sorted(self._items), []
+        return items
+
+
+def leer_dead_letters(ruta: Path) -> list[dict]:
+    if not ruta.exists():
+        return []
+    with ruta.open(encoding="utf-8") as archivo:
+        return [json.loads(linea) for linea in archivo if linea.strip()]
+
+
+def guardar_dead_letters(ruta: Path, entradas: list[dict], reemplazar: bool = False):
+    if reemplazar:
+        temporal = ruta.with_name(ruta.name + ".tmp")
+        temporal.write_text("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entradas), encoding="utf-8")
+        os.replace(temporal, ruta)
+        return
+    with ruta.open("a", encoding="utf-8") as archivo:
+        for entrada in entradas:
+            archivo.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+        archivo.flush()
+        os.fsync(archivo.fileno())
+
+
+def reintentar_diferidos(
+    diferidos: ColaDiferidos, args, desde_dt, hasta_dt, logger, cache, plan, escritor: EscritorCsv
+):
+    # Segunda pasada secuencial y pausada; lo que vuelve a fallar pasa al archivo de dead letters.
+    items = diferidos.extraer_todos()
+    if not items:
+        return
+    logger.warning("Reintentando %s detalles diferidos, de a uno", len(items))
+    muertos = []
+    session = sesion_http()
+    try:
+        for disponible_en, codigo, estado, intentos in items:
+            time.sleep(max(0.0, disponible_en - time.monotonic()))
+            try:
+                oc, _ = obtener_detalle(session, codigo, estado, args, logger, cache, args.diferir_tras)
+            except PeticionDiferida as exc:
+                oc = None
+                intentos += exc.intentos
+            else:
+                intentos += 1
+            finally:
+                time.sleep(args.pausa_diferidos)
+            if oc is None:
+                # Se guardan los filtros de la ejecución para aplicarlos igual en --retry-dead-letters.
+                muertos.append(
+                    {
+                        "codigo": codigo,
+                        "estado": estado,
+                        "desde": desde_dt.isoformat(),
+                        "hasta": hasta_dt.isoformat(),
+                        "organismos": plan.organismos if plan is not None else None,
+                        "proveedores": plan.proveedores if plan is not None else None,
+                        "intentos": intentos,
+                        "registrado": datetime.now().isoformat(timespec="seconds"),
+                    }
+                )
+                continue
+            escritor.agregar(codigo, oc, fila_en_rango(oc, desde_dt, hasta_dt, plan))
+    finally:
+        escritor.flush()
+    if muertos:
+        guardar_dead_letters(ruta_salida(args, args.dead_letter_archivo), muertos)
+        registrar_metrica("dead_letters", len(muertos))
+        logger.error(
+            "%s detalles siguen fallando y quedan en %s; reintente con --retry-dead-letters",
+            len(muertos),
+            ruta_salida(args, args.dead_letter_archivo),
+        )
+
+
+def procesar_detalle(session, codigo: str, estado: str, args, desde_dt, hasta_dt, logger, cache, plan=None):
+    desde_cache = False
+    try:
+        oc, desde_cache = obtener_detalle(session, codigo, estado, args, logger, cache, args.diferir_tras)
+        return oc, fila_en_rango(oc, desde_dt, hasta_dt, plan), desde_cache
+    finally:
+        if not desde_cache:
+            time.sleep(pausa_detalle(args))
+
+
+def descargar_detalle_y_escribir(
+    codigos,
+    args,
+    desde_dt,
+    hasta_dt,
+    logger,
+    cache: CacheApi | None = None,
+    bitacora: Bitacora | None = None,
+    plan: PlanConsulta | None = None,
+    anexar: bool = False,
+):
+    escritor = EscritorCsv(ruta_salida(args, "consulta_api.csv"), args, logger, bitacora, anexar)
+    codigos = escritor.pendientes(codigos)
+    aciertos_cache = 0
+    diferidos = ColaDiferidos()
+
+    if args.motor == "async":
+        total = len(codigos)
+        progress = tqdm(total=total, desc="Descargando", unit="oc") if tqdm else None
+        completados = 0
+
+        async def procesar_async(session, item):
+            nonlocal aciertos_cache, completados
+            codigo, estado = item
+            try:
+                oc, desde_cache = await obtener_detalle_async(
+                    session, codigo, estado, args, logger, cache, args.diferir_tras
+                )
+                if not desde_cache:
+                    await asyncio.sleep(pausa_detalle(args))
+            except ErrorFatalApi:
+                raise
+            except PeticionDiferida as exc:
+                diferidos.agregar(codigo, estado, exc.intentos)
+                oc, desde_cache = None, False
+            except Exception as exc:  # pragma: no cover
+                logger.exception("Error descargando código %s: %s", codigo, exc)
+                oc, desde_cache = None, False
+            if desde_cache:
+                aciertos_cache += 1
+            escritor.agregar(codigo, oc, fila_en_rango(oc, desde_dt, hasta_dt, plan))
+            completados += 1
+            if progress:
+                progress.update(1)
+            elif completados % args.progress_every == 0:
+                logger.info("Procesados %s de %s códigos", completados, total)
 
-    if args.workers <= 1:
-        session = requests.Session()
         try:
-            iterable = tqdm(codigos, desc="Descargando", unit="oc") if tqdm else codigos
-            for idx, codigo in enumerate(iterable, start=1):
-                params = {"codigo": codigo, "ticket": ticket}
-                response = request_with_retries(session, params, args.timeout, args.retries, logger)
-                if response is None:
-                    continue
+            asyncio.run(ejecutar_async(codigos.items(), procesar_async, args.concurrencia))
+        finally:
+            if progress:
+                progress.close()
+            escritor.flush()
+    elif args.workers <= 1:
+        session = sesion_http()
+        try:
+            pendientes = list(codigos.items())
+            iterable = tqdm(pendientes, desc="Descargando", unit="oc") if tqdm else pendientes
+            for idx, (codigo, estado) in enumerate(iterable, start=1):
                 try:
-                    payload = response.json()
-                except ValueError:  # pragma: no cover
-                    logger.error("Detalle no es JSON para código %s", codigo)
-                    continue
-                listado = payload.get("Listado") or []
-                if isinstance(listado, dict):
-                    listado = [listado]
-                if not listado:
-                    continue
-                oc = listado[0]
-                fecha_creacion = parse_fecha_json(safe_get(oc, "Fechas", "FechaCreacion"))
-                if fecha_creacion is None or fecha_creacion < desde_dt or fecha_creacion > hasta_dt:
-                    continue
-                fila = construir_fila_oc(oc)
-                filas_batch.append(fila)
-                if len(filas_batch) >= args.batch_size:
-                    flush()
+                    oc, fila, desde_cache = procesar_detalle(
+                        session, codigo, estado, args, desde_dt, hasta_dt, logger, cache, plan
+                    )
+                except PeticionDiferida as exc:
+                    diferidos.agregar(codigo, estado, exc.intentos)
+                    oc, fila, desde_cache = None, None, False
+                if desde_cache:
+                    aciertos_cache += 1
+                escritor.agregar(codigo, oc, fila)
                 if not tqdm and idx % args.progress_every == 0:
                     logger.info("Procesados %s de %s códigos", idx, len(codigos))
-                pausa = args.sleep_detail + random.uniform(0, max(args.sleep_detail * 0.1, 0.01))
-                time.sleep(pausa)
         finally:
-            session.close()
+            escritor.flush()
     else:
         total = len(codigos)
         progress = tqdm(total=total, desc="Descargando", unit="oc") if tqdm else None
 
-        def procesar(codigo: str):
-            session_local = _get_thread_session()
-            params = {"codigo": codigo, "ticket": ticket}
-            pausa = args.sleep_detail + random.uniform(0, max(args.sleep_detail * 0.1, 0.01))
-            try:
-                response = request_with_retries(session_local, params, args.timeout, args.retries, logger)
-                if response is None:
-                    return None
-                try:
-                    payload = response.json()
-                except ValueError:  # pragma: no cover
-                    logger.error("Detalle no es JSON para código %s", codigo)
-                    return None
-                listado = payload.get("Listado") or []
-                if isinstance(listado, dict):
-                    listado = [listado]
-                if not listado:
-                    return None
-                oc = listado[0]
-                fecha_creacion = parse_fecha_json(safe_get(oc, "Fechas", "FechaCreacion"))
-                if fecha_creacion is None or fecha_creacion < desde_dt or fecha_creacion > hasta_dt:
-                    return None
-                return construir_fila_oc(oc)
-            finally:
-                time.sleep(pausa)
+        def procesar(codigo: str, estado: str):
+            return procesar_detalle(
+                sesion_http(), codigo, estado, args, desde_dt, hasta_dt, logger, cache, plan
+            )
 
         try:
             with ThreadPoolExecutor(max_workers=args.workers) as executor:
-                future_to_codigo = {executor.submit(procesar, codigo): codigo for codigo in codigos}
-                for idx, future in enumerate(as_completed(future_to_codigo), start=1):
-                    codigo = future_to_codigo[future]
+                tareas = ((codigo, (codigo, estado)) for codigo, estado in codigos.items())
+                for idx, (codigo, future) in enumerate(
+                    ejecutar_acotado(executor, procesar, tareas, max_en_vuelo(args)), start=1
+                ):
                     try:
-                        fila = future.result()
+                        oc, fila, desde_cache = future.result()
+                    except ErrorFatalApi:
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    except PeticionDiferida as exc:
+                        diferidos.agregar(codigo, codigos[codigo], exc.intentos)
+                        oc, fila, desde_cache = None, None, False
                     except Exception as exc:  # pragma: no cover
                         logger.exception("Error descargando código %s: %s", codigo, exc)
-                        fila = None
-                    if fila:
-                        filas_batch.append(fila)
-                        if len(filas_batch) >= args.batch_size:
-                            flush()
+                        oc, fila, desde_cache = None, None, False
+                    if desde_cache:
+                        aciertos_cache += 1
+                    escritor.agregar(codigo, oc, fila)
                     if progress:
                         progress.update(1)
                     elif idx % args.progress_every == 0:
@@ -524,11 +2754,141 @@ def descargar_detalle_y_escribir(ticket, codigos, args, desde_dt, hasta_dt, logg
         finally:
             if progress:
                 progress.close()
-            _close_thread_sessions()
+            escritor.flush()
+
+    reintentar_diferidos(diferidos, args, desde_dt, hasta_dt, logger, cache, plan, escritor)
+    logger.info("Detalles servidos desde caché: %s de %s", aciertos_cache, len(codigos))
+    logger.info("Total de órdenes escritas: %s", escritor.escritos)
+    return escritor.csv_path
+
+
+_FIN_PIPELINE = object()
+
+
+def listar_y_descargar_en_pipeline(
+    organismos,
+    desde_dt,
+    hasta_dt,
+    args,
+    logger,
+    cache: CacheApi | None = None,
+    bitacora: Bitacora | None = None,
+    plan: PlanConsulta | None = None,
+):
+    escritor = EscritorCsv(ruta_salida(args, "consulta_api.csv"), args, logger, bitacora)
+    piso = piso_creacion(args, desde_dt)
+    cola_codigos: queue.Queue = queue.Queue(maxsize=args.cola_pipeline)
+    cola_resultados: queue.Queue = queue.Queue(maxsize=args.cola_pipeline)
+    detener = Event()
+    errores: list[BaseException] = []
+    omitidos = 0
+    diferidos = ColaDiferidos()
+
+    def al_descubrir(codigo: str, estado: str):
+        nonlocal omitidos
+        if escritor.omitir(codigo, estado):
+            omitidos += 1
+            return
+        # Si el detalle se atrasa, el listado espera aquí (contrapresión).
+        while True:
+            if detener.is_set():
+                raise RuntimeError("Pipeline detenido")
+            try:
+                cola_codigos.put((codigo, estado), timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def cerrar_cola_codigos():
+        for _ in range(args.workers):
+            while True:
+                try:
+                    cola_codigos.put(_FIN_PIPELINE, timeout=0.5)
+                    break
+                except queue.Full:
+                    if detener.is_set():
+                        # Los trabajadores ya no consumen: se descartan códigos pendientes para dejar espacio.
+                        with contextlib.suppress(queue.Empty):
+                            cola_codigos.get_nowait()
+
+    def listar():
+        try:
+            codigos = listar_oc_por_rango(
+                organismos, desde_dt, hasta_dt, args, logger, cache, bitacora, al_descubrir, plan
+            )
+            logger.info("Total de códigos únicos obtenidos: %s", len(codigos))
+        except BaseException as exc:  # noqa: BLE001 - se relanza en el hilo principal
+            if not detener.is_set():
+                errores.append(exc)
+            detener.set()
+        finally:
+            cerrar_cola_codigos()
+
+    def trabajador_detalle():
+        session = sesion_http()
+        while True:
+            item = cola_codigos.get()
+            if item is _FIN_PIPELINE or detener.is_set():
+                cola_resultados.put(_FIN_PIPELINE)
+                return
+            codigo, estado = item
+            try:
+                resultado = procesar_detalle(session, codigo, estado, args, piso, hasta_dt, logger, cache, plan)
+            except ErrorFatalApi as exc:
+                errores.append(exc)
+                detener.set()
+                cola_resultados.put(_FIN_PIPELINE)
+                return
+            except PeticionDiferida as exc:
+                diferidos.agregar(codigo, estado, exc.intentos)
+                resultado = (None, None, False)
+            except Exception as exc:  # pragma: no cover
+                logger.exception("Error descargando código %s: %s", codigo, exc)
+                resultado = (None, None, False)
+            cola_resultados.put((codigo, *resultado))
+
+    hilo_listado = Thread(target=listar, name="pipeline-listado", daemon=True)
+    hilos_detalle = [
+        Thread(target=trabajador_detalle, name=f"pipeline-detalle-{i}", daemon=True) for i in range(args.workers)
+    ]
+    hilo_listado.start()
+    for hilo in hilos_detalle:
+        hilo.start()
+
+    progress = tqdm(desc="Descargando", unit="oc") if tqdm else None
+    procesados = 0
+    aciertos_cache = 0
+    activos = len(hilos_detalle)
+    try:
+        while activos:
+            item = cola_resultados.get()
+            if item is _FIN_PIPELINE:
+                activos -= 1
+                continue
+            codigo, oc, fila, desde_cache = item
+            if desde_cache:
+                aciertos_cache += 1
+            escritor.agregar(codigo, oc, fila)
+            procesados += 1
+            if progress:
+                progress.update(1)
+            elif procesados % args.progress_every == 0:
+                logger.info("Procesados %s códigos", procesados)
+    finally:
+        detener.set()
+        if progress:
+            progress.close()
+        escritor.flush()
 
-    flush()
-    logger.info("Total de órdenes escritas: %s", escritos)
-    return csv_path
+    hilo_listado.join()
+    if errores:
+        raise errores[0]
+    reintentar_diferidos(diferidos, args, piso, hasta_dt, logger, cache, plan, escritor)
+    if escritor.reanudando:
+        logger.info("Reanudando detalle: %s códigos ya procesados", omitidos)
+    logger.info("Detalles servidos desde caché: %s de %s", aciertos_cache, procesados)
+    logger.info("Total de órdenes escritas: %s", escritor.escritos)
+    return escritor.csv_path
 
 
 def generar_excel_desde_csv(csv_path: Path, xlsx_path: Path, columnas_orden):
@@ -541,6 +2901,55 @@ def generar_excel_desde_csv(csv_path: Path, xlsx_path: Path, columnas_orden):
         df.to_excel(writer, index=False, sheet_name="Órdenes de Compra")
 
 
+def avance_fila(fila: dict) -> tuple:
+    # Orden de "más reciente" entre filas de un mismo código: estado terminal, fechas de aceptación y envío,
+    # número de estado y, para empates, los valores de la fila, de modo que no dependa del orden de lectura.
+    fechas = []
+    for columna in ("Fecha Aceptación", "Fecha Envío"):
+        try:
+            fechas.append(datetime.strptime(fila.get(columna) or "", "%d-%m-%Y").date())
+        except ValueError:
+            fechas.append(date.min)
+    estado = normalizar_estado(fila.get("Código Estado"))
+    return (
+        estado in ESTADOS_TERMINALES,
+        *fechas,
+        int(estado) if estado.isdigit() else -1,
+        tuple(fila.get(columna) or "" for columna in COLUMNAS),
+    )
+
+
+def combinar_csv(archivos: list[Path], destino: Path, logger: logging.Logger):
+    # Une las salidas de los nodos de --shard. Dentro de un archivo vale la última fila de cada código (las filas
+    # se agregan en orden); si el código aparece en varios (listado en días de distintos fragmentos) se queda la
+    # fila más avanzada según avance_fila. Las filas se escriben ordenadas por código, así el resultado no
+    # depende del orden de los archivos.
+    filas: dict[str, dict] = {}
+    leidas = 0
+    for archivo in archivos:
+        propias: dict[str, dict] = {}
+        with archivo.open(newline="", encoding="utf-8") as entrada:
+            for numero, fila in enumerate(csv.DictReader(entrada), start=1):
+                leidas += 1
+                propias[fila.get("Código OC") or f"sin-codigo-{archivo.name}-{numero}"] = fila
+        for codigo, fila in propias.items():
+            if codigo not in filas or avance_fila(fila) > avance_fila(filas[codigo]):
+                filas[codigo] = fila
+    temporal = destino.with_name(destino.name + ".tmp")
+    with temporal.open("w", newline="", encoding="utf-8") as salida:
+        writer = csv.DictWriter(salida, fieldnames=COLUMNAS, restval="", extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(fila for _, fila in sorted(filas.items()))
+    os.replace(temporal, destino)
+    logger.info(
+        "Combinados %s archivos: %s filas leídas, %s órdenes únicas en %s",
+        len(archivos),
+        leidas,
+        len(filas),
+        destino,
+    )
+
+
 def duplicar_log():
     origen = Path("log_api.txt")
     destino = Path("log_api")
@@ -553,14 +2962,198 @@ def parse_args():
         description="Consulta la API de Mercado Público",
         allow_abbrev=False,
     )
-    parser.add_argument("--desde", required=True, type=parse_fecha_arg)
-    parser.add_argument("--hasta", required=True, type=parse_fecha_arg)
-    parser.add_argument("--ticket", required=True, type=parse_ticket)
-    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--desde", type=parse_fecha_arg)
+    parser.add_argument("--hasta", type=parse_fecha_arg)
+    parser.add_argument(
+        "--ticket",
+        dest="tickets",
+        action="append",
+        type=parse_ticket,
+        help="Ticket/token de la API; se puede repetir para usar varios",
+    )
+    parser.add_argument(
+        "--tickets-file",
+        dest="tickets_file",
+        help="Archivo con un ticket por línea (las líneas vacías o que comienzan con # se ignoran)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120.0,
+        help="Tiempo máximo de lectura en segundos; con el tiempo adaptativo es el tope",
+    )
+    parser.add_argument(
+        "--timeout-minimo",
+        dest="timeout_minimo",
+        type=float,
+        default=5.0,
+        help="Piso en segundos del tiempo de lectura adaptativo por endpoint",
+    )
+    parser.add_argument(
+        "--sin-timeout-adaptativo",
+        dest="timeout_adaptativo",
+        action="store_false",
+        help="Usa siempre --timeout en lugar de derivarlo de las latencias observadas",
+    )
     parser.add_argument("--sleep", type=float, default=0.20)
     parser.add_argument("--sleep-detail", dest="sleep_detail", type=float, default=0.22)
     parser.add_argument("--progress-every", dest="progress_every", type=int, default=100)
     parser.add_argument("--batch-size", dest="batch_size", type=int, default=1000)
+    parser.add_argument(
+        "--rate",
+        dest="tasa",
+        type=float,
+        default=None,
+        help="Peticiones por segundo por ticket; reemplaza las pausas --sleep y --sleep-detail",
+    )
+    parser.add_argument(
+        "--burst",
+        dest="rafaga",
+        type=int,
+        default=1,
+        help="Cantidad de peticiones que pueden salir seguidas antes de aplicar --rate",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Consulta solo los días posteriores al último día sincronizado de cada organismo",
+    )
+    parser.add_argument(
+        "--dias-revision",
+        dest="dias_revision",
+        type=int,
+        default=3,
+        help="Días ya sincronizados que se vuelven a consultar con --incremental (por defecto 3)",
+    )
+    parser.add_argument(
+        "--marcas-archivo",
+        dest="marcas_archivo",
+        default="sincronizacion.json",
+        help="Archivo con el último día sincronizado de cada organismo (por defecto sincronizacion.json)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Consulta los listados de hoy cada --intervalo segundos y descarga solo órdenes nuevas o con cambios",
+    )
+    parser.add_argument(
+        "--intervalo",
+        type=float,
+        default=300.0,
+        help="Segundos entre consultas con --watch (por defecto 300)",
+    )
+    parser.add_argument(
+        "--diferir-tras",
+        dest="diferir_tras",
+        type=int,
+        default=3,
+        help=(
+            "Intentos fallidos tras los que el detalle se aparta para reintentarlo al final y, si vuelve a fallar, "
+            "se guarda en --dead-letter-archivo (0 para reintentar siempre en el mismo trabajador)"
+        ),
+    )
+    parser.add_argument(
+        "--pausa-diferidos",
+        dest="pausa_diferidos",
+        type=float,
+        default=2.0,
+        help="Segundos entre peticiones al reintentar detalles diferidos o pendientes",
+    )
+    parser.add_argument(
+        "--dead-letter-archivo",
+        dest="dead_letter_archivo",
+        default="consulta_api.deadletter.jsonl",
+        help="Archivo con los detalles que siguieron fallando tras la pasada de reintentos",
+    )
+    parser.add_argument(
+        "--retry-dead-letters",
+        dest="retry_dead_letters",
+        action="store_true",
+        help="Solo reintenta los detalles guardados en --dead-letter-archivo y los agrega al CSV",
+    )
+    parser.add_argument(
+        "--hedge",
+        type=float,
+        default=0.0,
+        help=(
+            "Percentil de latencia observada (por ejemplo 95) tras el cual se envía un duplicado de un detalle "
+            "lento y se usa la primera respuesta (0 desactiva)"
+        ),
+    )
+    parser.add_argument(
+        "--hedge-max",
+        dest="hedge_max",
+        type=float,
+        default=0.05,
+        help="Fracción máxima de detalles que pueden duplicarse con --hedge (por defecto 0.05)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help=(
+            "Fragmento i/n que ejecuta este nodo (por ejemplo 2/4): lista solo las combinaciones de día y clave "
+            "que le asigna un hash estable y escribe archivos propios (consulta_api.shard2de4.csv)"
+        ),
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        type=Path,
+        metavar="CSV",
+        help="Combina los CSV de los fragmentos en consulta_api.csv sin repetir Código OC y termina",
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Estima consultas, detalles y duración sin hacer peticiones a la API",
+    )
+    parser.add_argument(
+        "--cuota-diaria",
+        dest="cuota_diaria",
+        type=int,
+        default=CUOTA_DIARIA_POR_TICKET,
+        help=f"Peticiones diarias por ticket (por defecto {CUOTA_DIARIA_POR_TICKET}; 0 para no planificar por cuota)",
+    )
+    parser.add_argument(
+        "--cuota-archivo",
+        dest="cuota_archivo",
+        default="cuota_api.sqlite",
+        help="Archivo donde se acumulan las peticiones diarias de cada ticket (por defecto cuota_api.sqlite)",
+    )
+    parser.add_argument(
+        "--no-esperar-cuota",
+        dest="esperar_cuota",
+        action="store_false",
+        help="Si la cuota no alcanza, ejecuta solo lo que cabe hoy en lugar de esperar el reinicio diario",
+    )
+    parser.add_argument(
+        "--max-simultaneas-ticket",
+        dest="max_simultaneas_ticket",
+        type=parse_workers,
+        default=None,
+        help="Peticiones en curso permitidas por ticket (por defecto sin límite)",
+    )
+    parser.add_argument(
+        "--umbral-circuito",
+        dest="umbral_circuito",
+        type=int,
+        default=10,
+        help="Fallos consecutivos que abren el circuito y pausan todas las peticiones",
+    )
+    parser.add_argument(
+        "--pausa-circuito",
+        dest="pausa_circuito",
+        type=float,
+        default=30.0,
+        help="Segundos iniciales de pausa con el circuito abierto (se duplica si la sonda falla)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        dest="adaptativo",
+        action="store_true",
+        help="Ajusta la concurrencia automáticamente (AIMD) usando --workers o --concurrencia como máximo",
+    )
     parser.add_argument(
         "--retries",
         type=int,
@@ -573,7 +3166,178 @@ def parse_args():
         default=max(1, min(8, (os.cpu_count() or 4))),
         help="Cantidad de hilos para peticiones concurrentes (1 para modo secuencial)",
     )
-    return parser.parse_args()
+    parser.add_argument("--cache", default="cache_api.sqlite", help="Ruta del archivo de caché persistente")
+    parser.add_argument("--sin-cache", dest="sin_cache", action="store_true", help="Desactiva la caché persistente")
+    parser.add_argument(
+        "--cache-dias-inmutable",
+        dest="cache_dias_inmutable",
+        type=int,
+        default=7,
+        help="Antigüedad en días a partir de la cual un listado guardado se considera definitivo",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        type=float,
+        default=3600.0,
+        help="Vigencia en segundos de los listados de días recientes",
+    )
+    parser.add_argument(
+        "--cache-ttl-detalle",
+        dest="cache_ttl_detalle",
+        type=float,
+        default=86400.0,
+        help="Vigencia en segundos del detalle de órdenes en estados no terminales",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="reanudar",
+        action="store_true",
+        help="Reanuda una ejecución interrumpida usando la bitácora y el CSV existentes",
+    )
+    parser.add_argument(
+        "--max-en-vuelo",
+        dest="max_en_vuelo",
+        type=parse_workers,
+        default=None,
+        help="Tareas enviadas a los hilos sin terminar a la vez (por defecto el doble de --workers)",
+    )
+    parser.add_argument(
+        "--organismo",
+        dest="organismos",
+        action="append",
+        type=parse_codigo,
+        help="Código de organismo a consultar (repetible); reemplaza la lista ORGANISMOS del script",
+    )
+    parser.add_argument(
+        "--todos-organismos",
+        dest="todos_organismos",
+        action="store_true",
+        help="No filtra por organismo comprador (útil junto a --proveedor)",
+    )
+    parser.add_argument(
+        "--proveedor",
+        dest="proveedores",
+        action="append",
+        type=parse_codigo,
+        help="Código de proveedor (CodigoProveedor) a consultar (repetible)",
+    )
+    parser.add_argument(
+        "--estrategia",
+        choices=("auto", "organismo", "proveedor", "global"),
+        default="auto",
+        help="Dimensión del listado (por organismo, por proveedor o global por día) o elegir según el costo estimado",
+    )
+    parser.add_argument(
+        "--solo-prefijos-conocidos",
+        dest="solo_prefijos_conocidos",
+        action="store_true",
+        help="En el listado global, descarta órdenes cuya unidad compradora no se conoce en la caché",
+    )
+    parser.add_argument(
+        "--prefiltro",
+        choices=("completo", "anio", "no"),
+        default="completo",
+        help=(
+            "Omite el detalle de órdenes creadas fuera del rango según el año del código (anio), además de las "
+            "fechas que informe el listado (completo, por defecto), o las descarga todas (no)"
+        ),
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Descarga el detalle de cada código apenas lo entrega el listado, en lugar de esperar el listado completo",
+    )
+    parser.add_argument(
+        "--cola-pipeline",
+        dest="cola_pipeline",
+        type=parse_workers,
+        default=1000,
+        help="Capacidad de la cola entre listado y detalle con --pipeline",
+    )
+    parser.add_argument(
+        "--engine",
+        dest="motor",
+        choices=("threads", "async"),
+        default="threads",
+        help="Motor de peticiones: hilos con requests o un único bucle asyncio con aiohttp",
+    )
+    parser.add_argument(
+        "--transporte",
+        choices=("requests", "httpx"),
+        default="requests",
+        help="Cliente HTTP con --engine threads: requests (HTTP/1.1) o httpx con HTTP/2 (requiere httpx[http2])",
+    )
+    parser.add_argument(
+        "--sin-precalentar",
+        dest="precalentar",
+        action="store_false",
+        help="No abre las conexiones con la API antes de la primera consulta",
+    )
+    parser.add_argument(
+        "--concurrencia",
+        type=parse_workers,
+        default=64,
+        help="Peticiones simultáneas máximas con --engine async",
+    )
+    args = parser.parse_args()
+    args.tickets = list(args.tickets or [])
+    if args.tickets_file:
+        try:
+            args.tickets.extend(leer_tickets(Path(args.tickets_file)))
+        except OSError as exc:
+            parser.error(f"No se pudo leer {args.tickets_file}: {exc}")
+    if args.merge:
+        if args.watch or args.incremental or args.retry_dead_letters or args.dry_run or args.shard:
+            parser.error("--merge solo combina archivos CSV; no se puede usar con otros modos")
+        if args.desde is not None or args.hasta is not None:
+            parser.error("--merge no usa --desde ni --hasta")
+        return args
+    if not args.tickets:
+        parser.error("Debe indicar al menos un ticket con --ticket o --tickets-file")
+    if args.cuota_diaria < 0:
+        parser.error("--cuota-diaria no puede ser negativa")
+    if args.watch:
+        if args.desde is not None or args.hasta is not None:
+            parser.error("--watch consulta siempre el día en curso; no use --desde ni --hasta")
+        if args.incremental or args.pipeline or args.reanudar or args.retry_dead_letters:
+            parser.error("--watch no se puede combinar con --incremental, --pipeline, --resume ni --retry-dead-letters")
+        if args.intervalo <= 0:
+            parser.error("--intervalo debe ser mayor que cero")
+    elif args.retry_dead_letters:
+        if args.incremental or args.dry_run or args.desde is not None or args.hasta is not None:
+            parser.error("--retry-dead-letters usa el rango guardado con cada código; no use fechas ni otros modos")
+    elif not args.incremental and (args.desde is None or args.hasta is None):
+        parser.error("--desde y --hasta son obligatorios salvo con --incremental, --watch o --retry-dead-letters")
+    if args.timeout <= 0 or args.timeout_minimo <= 0:
+        parser.error("--timeout y --timeout-minimo deben ser mayores que cero")
+    if not 0 <= args.hedge < 100 or not 0 <= args.hedge_max <= 1:
+        parser.error("--hedge debe estar entre 0 y 100 y --hedge-max entre 0 y 1")
+    if args.diferir_tras < 0 or args.pausa_diferidos < 0:
+        parser.error("--diferir-tras y --pausa-diferidos no pueden ser negativos")
+    if args.dias_revision < 0:
+        parser.error("--dias-revision no puede ser negativo")
+    if args.motor == "async" and aiohttp is None:
+        parser.error("--engine async requiere el paquete aiohttp")
+    if args.todos_organismos and args.organismos:
+        parser.error("--todos-organismos no puede combinarse con --organismo")
+    if args.estrategia == "organismo" and args.todos_organismos:
+        parser.error("--estrategia organismo requiere una lista de organismos")
+    if args.estrategia == "proveedor" and not args.proveedores:
+        parser.error("--estrategia proveedor requiere al menos un --proveedor")
+    if args.pipeline and args.motor == "async":
+        parser.error("--pipeline solo está disponible con --engine threads")
+    if args.shard is not None:
+        if args.watch or args.incremental:
+            parser.error("--shard no se puede combinar con --watch ni --incremental")
+        if args.estrategia == "auto":
+            # La elección automática depende de la caché de cada nodo y los fragmentos no coincidirían.
+            parser.error("--shard requiere una --estrategia explícita, la misma en todos los nodos")
+    if args.transporte == "httpx" and httpx is None:
+        parser.error("--transporte httpx requiere el paquete httpx con soporte HTTP/2 (httpx[http2])")
+    if args.transporte == "httpx" and args.motor == "async":
+        parser.error("--transporte solo aplica a --engine threads; el motor async usa aiohttp")
+    return args
 
 
 def validar_rango(desde: date, hasta: date):
@@ -581,32 +3345,370 @@ def validar_rango(desde: date, hasta: date):
         raise ValueError("La fecha hasta no puede ser anterior a la fecha desde")
 
 
+def formatear_duracion(segundos: float) -> str:
+    minutos, segundos = divmod(round(segundos), 60)
+    horas, minutos = divmod(minutos, 60)
+    if horas:
+        return f"{horas} h {minutos:02d} min"
+    if minutos:
+        return f"{minutos} min {segundos:02d} s"
+    return f"{segundos} s"
+
+
+def estimar_duracion(listados: int, detalles: float, args, latencias: dict[str, float]) -> float:
+    paralelismo = args.concurrencia if args.motor == "async" else args.workers
+    tope = args.tasa * len(_POOL.tickets) if args.tasa and _POOL is not None else None
+
+    def fase(peticiones: float, latencia: float, pausa: float) -> float:
+        if not peticiones:
+            return 0.0
+        ritmo = paralelismo / (latencia + pausa)
+        return peticiones / (min(ritmo, tope) if tope else ritmo)
+
+    duracion_listado = fase(listados, latencias["listado"], pausa_listado(args))
+    duracion_detalle = fase(detalles, latencias["detalle"], 0.0 if args.tasa else args.sleep_detail)
+    if args.pipeline:
+        return max(duracion_listado, duracion_detalle, (listados + detalles) / tope if tope else 0.0)
+    return duracion_listado + duracion_detalle
+
+
+def simular_ejecucion(plan: PlanConsulta, args, cache, bitacora, logger):
+    costos = estimar_costo_por_dia(plan, args.desde, args.hasta, cache, bitacora, args.prefiltro)
+    listados = sum(costo[0] for costo in costos.values())
+    detalles = sum(costo[1] for costo in costos.values())
+    combinaciones = sum(len(plan.claves_del_dia(dia)) for dia in costos)
+    logger.info(
+        "Simulación: %s consultas de listado (%s de %s ya guardadas en la caché o la bitácora)",
+        listados,
+        combinaciones - listados,
+        combinaciones,
+    )
+    logger.info("Simulación: ~%.0f descargas de detalle estimadas", detalles)
+    observadas = cache.latencias() if cache is not None else {}
+    latencias = {**LATENCIA_ESTIMADA, **observadas}
+    logger.info(
+        "Simulación: latencia por petición %s",
+        ", ".join(
+            f"{endpoint}={segundos:.2f}s ({'observada' if endpoint in observadas else 'por defecto'})"
+            for endpoint, segundos in latencias.items()
+        ),
+    )
+    logger.info(
+        "Simulación: duración estimada %s (%s, %s)",
+        formatear_duracion(estimar_duracion(listados, detalles, args, latencias)),
+        f"--concurrencia {args.concurrencia}" if args.motor == "async" else f"--workers {args.workers}",
+        f"{args.tasa:g} peticiones/s por ticket" if args.tasa else f"pausas {args.sleep:g}s/{args.sleep_detail:g}s",
+    )
+    planificar_cuota(plan, args, cache, bitacora, logger, costos)
+
+
+def vigilar_listados(organismos, args, logger, cache, plan: PlanConsulta):
+    csv_path = ruta_salida(args, "consulta_api.csv")
+    # Estado conocido de cada código por día de listado; al reiniciar se parte de lo ya escrito en el CSV.
+    anteriores = {hoy_api(): leer_estados_csv(csv_path)}
+    logger.info("Vigilando los listados de hoy cada %s s (Ctrl+C para detener)", args.intervalo)
+    try:
+        while True:
+            inicio = time.monotonic()
+            hoy = hoy_api()
+            # Al cambiar de día se consulta una última vez el anterior para no perder sus cambios finales.
+            dias = sorted(dia for dia in anteriores if dia < hoy) + [hoy]
+            try:
+                hubo_cambios = False
+                for dia in dias:
+                    previos = anteriores.get(dia, {})
+                    actuales = listar_oc_por_rango(organismos, dia, dia, args, logger, plan=plan, modo_prefiltro="no")
+                    cambios = {codigo: estado for codigo, estado in actuales.items() if previos.get(codigo) != estado}
+                    nuevos = sum(1 for codigo in cambios if codigo not in previos)
+                    logger.info(
+                        "Sondeo de %s: %s órdenes listadas, %s nuevas y %s con cambio de estado",
+                        dia,
+                        len(actuales),
+                        nuevos,
+                        len(cambios) - nuevos,
+                    )
+                    if cambios:
+                        # El listado del día incluye órdenes creadas antes que cambiaron de estado hoy; en la
+                        # vigilancia se descargan y escriben todas, sin filtrar por fecha de creación.
+                        descargar_detalle_y_escribir(
+                            cambios, args, date.min, date.max, logger, cache, plan=plan, anexar=True
+                        )
+                        hubo_cambios = True
+                    # Un código que falta en un sondeo (por ejemplo, por una consulta fallida) se mantiene conocido.
+                    anteriores[dia] = {**previos, **actuales}
+                anteriores = {hoy: anteriores[hoy]}
+                if hubo_cambios and csv_path.exists():
+                    generar_excel_desde_csv(csv_path, ruta_salida(args, "consulta_api.xlsx"), COLUMNAS)
+            except ErrorCuotaAgotada:
+                esperar_reinicio_cuota(logger)
+                continue
+            time.sleep(max(0.0, args.intervalo - (time.monotonic() - inicio)))
+    except KeyboardInterrupt:
+        logger.info("Vigilancia detenida")
+
+
+def esperar_reinicio_cuota(logger: logging.Logger):
+    espera = segundos_hasta_reinicio_cuota() + 60
+    logger.warning(
+        "Cuota diaria agotada; se continúa tras el reinicio en %.0f minutos (%s)",
+        espera / 60,
+        (datetime.now() + timedelta(seconds=espera)).strftime("%Y-%m-%d %H:%M"),
+    )
+    time.sleep(espera)
+    _POOL.reactivar_cuota()
+
+
+def reintentar_dead_letters(organismos, args, logger, cache):
+    ruta = ruta_salida(args, args.dead_letter_archivo)
+    entradas = leer_dead_letters(ruta)
+    if not entradas:
+        logger.info("No hay detalles pendientes en %s", ruta)
+        return
+    csv_path = ruta_salida(args, "consulta_api.csv")
+    ya_escritos = leer_codigos_csv(csv_path) if csv_path.exists() else set()
+    escritor = EscritorCsv(csv_path, args, logger, anexar=True)
+    logger.info("Reintentando %s detalles pendientes de %s", len(entradas), ruta)
+    quedan = []
+    resueltos = 0
+    session = sesion_http()
+    try:
+        for entrada in entradas:
+            if entrada["codigo"] in ya_escritos:
+                resueltos += 1
+                continue
+            intentos = 1
+            try:
+                oc, _ = obtener_detalle(
+                    session, entrada["codigo"], entrada["estado"], args, logger, cache, args.diferir_tras
+                )
+            except PeticionDiferida as exc:
+                oc = None
+                intentos = exc.intentos
+            finally:
+                time.sleep(args.pausa_diferidos)
+            if oc is None:
+                quedan.append({**entrada, "intentos": entrada.get("intentos", 0) + intentos})
+                continue
+            # Los filtros son los de la ejecución original; las entradas antiguas sin ellos usan los actuales.
+            if "organismos" in entrada:
+                plan = PlanConsulta("global", entrada["organismos"], entrada.get("proveedores"))
+            else:
+                plan = PlanConsulta("global", organismos, args.proveedores)
+            desde_dt = date.fromisoformat(entrada["desde"])
+            hasta_dt = date.fromisoformat(entrada["hasta"])
+            escritor.agregar(entrada["codigo"], oc, fila_en_rango(oc, desde_dt, hasta_dt, plan))
+            resueltos += 1
+    finally:
+        escritor.flush()
+        # Se reescribe siempre, para no volver a intentar lo ya resuelto aunque la pasada se interrumpa.
+        procesados = {e["codigo"] for e in entradas[: resueltos + len(quedan)]}
+        restantes = quedan + [e for e in entradas if e["codigo"] not in procesados]
+        if restantes:
+            guardar_dead_letters(ruta, restantes, reemplazar=True)
+        else:
+            ruta.unlink()
+    logger.info("Detalles pendientes resueltos: %s; siguen pendientes: %s", resueltos, len(restantes))
+    if csv_path.exists():
+        generar_excel_desde_csv(csv_path, ruta_salida(args, "consulta_api.xlsx"), COLUMNAS)
+
+
+def ejecutar_tramo(organismos, desde_dt: date, hasta_dt: date, args, logger, cache, bitacora, plan):
+    if args.pipeline:
+        csv_path = listar_y_descargar_en_pipeline(organismos, desde_dt, hasta_dt, args, logger, cache, bitacora, plan)
+    else:
+        codigos = listar_oc_por_rango(organismos, desde_dt, hasta_dt, args, logger, cache, bitacora, plan=plan)
+        logger.info("Total de códigos únicos obtenidos: %s", len(codigos))
+
+        csv_path = descargar_detalle_y_escribir(
+            codigos, args, piso_creacion(args, desde_dt), hasta_dt, logger, cache, bitacora, plan
+        )
+    if csv_path.exists():
+        generar_excel_desde_csv(csv_path, ruta_salida(args, "consulta_api.xlsx"), COLUMNAS)
+        logger.info("Archivos generados: %s y %s", csv_path.name, ruta_salida(args, "consulta_api.xlsx").name)
+    else:
+        logger.warning("No se generó archivo CSV")
+
+
 def main():
     args = parse_args()
     try:
-        validar_rango(args.desde, args.hasta)
+        if args.desde is not None and args.hasta is not None:
+            validar_rango(args.desde, args.hasta)
     except ValueError as exc:
         print(str(exc), file=sys.stderr)
         return 1
 
     logger = configurar_logger()
-    logger.info("Inicio de consulta desde %s hasta %s", args.desde, args.hasta)
-
+    if args.merge:
+        destino = Path("consulta_api.csv")
+        try:
+            combinar_csv(args.merge, destino, logger)
+        except OSError as exc:
+            logger.error("No se pudieron combinar los archivos: %s", exc)
+            duplicar_log()
+            return 1
+        generar_excel_desde_csv(destino, Path("consulta_api.xlsx"), COLUMNAS)
+        logger.info("Archivos generados: %s y consulta_api.xlsx", destino.name)
+        duplicar_log()
+        return 0
+    organismos = None if args.todos_organismos else (args.organismos or ORGANISMOS)
+    marcas = None
+    inicios = None
+    if args.watch:
+        args.desde = args.hasta = hoy_api()
+    if args.incremental:
+        marcas = MarcasSincronizacion(Path(args.marcas_archivo))
+        args.hasta = args.hasta or hoy_api()
+        try:
+            inicios = inicios_incrementales(organismos, args.proveedores, args, marcas)
+        except ValueError as exc:
+            logger.error("%s", exc)
+            duplicar_log()
+            return 1
+        if not inicios:
+            logger.info("Sincronización al día: no hay días pendientes hasta %s", args.hasta)
+            duplicar_log()
+            return 0
+        args.desde = min(inicios.values())
+        logger.info(
+            "Modo incremental: %s de %s organismos con días pendientes",
+            len(inicios),
+            len(organismos) if organismos is not None else 1,
+        )
+    if not args.retry_dead_letters:
+        logger.info("Inicio de consulta desde %s hasta %s", args.desde, args.hasta)
+    if args.shard is not None:
+        logger.info("Fragmento %s de %s: archivos de salida %s", *args.shard, ruta_salida(args, "consulta_api.csv"))
     try:
-        codigos = listar_oc_por_rango(args.ticket, ORGANISMOS, args.desde, args.hasta, args, logger)
-        logger.info("Total de códigos únicos obtenidos: %s", len(codigos))
+        # Una simulación no debe reiniciar la bitácora (solo la lee si se pide --resume); --watch y
+        # --retry-dead-letters no la usan.
+        bitacora = None
+        if not (args.watch or args.retry_dead_letters) and (not args.dry_run or args.reanudar):
+            firma = {
+                "desde": args.desde.isoformat(),
+                "hasta": args.hasta.isoformat(),
+                "organismos": sorted(organismos) if organismos is not None else "todos",
+                "proveedores": sorted(args.proveedores or []),
+            }
+            if args.shard is not None:
+                firma["fragmento"] = "/".join(map(str, args.shard))
+            bitacora = Bitacora(ruta_salida(args, "consulta_api.journal"), firma, args.reanudar, logger)
+    except ValueError as exc:
+        logger.error("%s", exc)
+        duplicar_log()
+        return 1
+    cache = abrir_cache(args, logger)
+    registro_cuota = RegistroCuota(Path(args.cuota_archivo), args.cuota_diaria)
+    configurar_pool(args.tickets, args.tasa, args.rafaga, logger, args.max_simultaneas_ticket, registro_cuota)
+    logger.info("Tickets disponibles: %s", len(_POOL.tickets))
+    if args.tasa:
+        logger.info("Limitador por ticket: %.2f peticiones/s con ráfaga de %s", args.tasa, args.rafaga)
+    configurar_circuito(args.umbral_circuito, args.pausa_circuito, logger)
+    configurar_concurrencia(args.adaptativo, args.concurrencia if args.motor == "async" else args.workers, logger)
+    if _CONCURRENCIA is not None:
+        logger.info("Concurrencia adaptativa: inicio en %s, máximo %s", _CONCURRENCIA.nivel, _CONCURRENCIA.maximo)
+    configurar_timeouts(
+        args.timeout_minimo if args.timeout_adaptativo else None,
+        args.timeout,
+        cache.latencias() if cache is not None else None,
+    )
+    # Con --engine async las pasadas secuenciales (verificación, diferidos) usan el camino con hilos: una
+    # petición y su duplicado.
+    configurar_cobertura(args.hedge, args.hedge_max, 2 * args.workers if args.motor == "threads" else 2)
+    # Con --pipeline listado y detalle usan cada uno --workers hilos; los duplicados de --hedge suman otros tantos.
+    conexiones = args.workers * (2 if args.pipeline else 1) + (args.workers if args.hedge else 0)
+    configurar_transporte(args.transporte, conexiones)
+    if args.precalentar and args.motor == "threads" and not args.dry_run:
+        precalentar_conexiones(1 if args.transporte == "httpx" else args.workers, logger)
+    if _COBERTURA is not None:
+        logger.info(
+            "Duplicados de detalle tras el percentil %s de latencia, hasta %.0f%% de los detalles",
+            args.hedge,
+            args.hedge_max * 100,
+        )
 
-        csv_path = descargar_detalle_y_escribir(args.ticket, codigos, args, args.desde, args.hasta, logger)
-        if csv_path.exists():
-            generar_excel_desde_csv(csv_path, Path("consulta_api.xlsx"), COLUMNAS)
-            logger.info("Archivos generados: %s y consulta_api.xlsx", csv_path.name)
-        else:
-            logger.warning("No se generó archivo CSV")
+    try:
+        if args.retry_dead_letters:
+            reintentar_dead_letters(organismos, args, logger, cache)
+            registrar_resumen(logger)
+            duplicar_log()
+            return 0
+        plan = planificar_consulta(
+            organismos, args.proveedores, args.desde, args.hasta, args, cache, logger, inicios
+        )
+        if args.dry_run:
+            simular_ejecucion(plan, args, cache, bitacora, logger)
+            duplicar_log()
+            return 0
+        if args.watch:
+            vigilar_listados(organismos, args, logger, cache, plan)
+            registrar_resumen(logger)
+            duplicar_log()
+            return 0
+        tramos = planificar_cuota(plan, args, cache, bitacora, logger)
+        pendientes = [dia for tramo in tramos for dia in tramo]
+        numero = 0
+        while pendientes:
+            dias = tramos[0]
+            if not dias:
+                if not args.esperar_cuota:
+                    logger.warning(
+                        "Quedan pendientes los días %s a %s; vuelva a ejecutar con %s tras el reinicio de la cuota",
+                        pendientes[0].isoformat(),
+                        pendientes[-1].isoformat(),
+                        "--incremental" if args.incremental else "--resume",
+                    )
+                    break
+                esperar_reinicio_cuota(logger)
+            else:
+                numero += 1
+                while True:
+                    if numero > 1 or len(tramos) > 1:
+                        logger.info("Tramo %s de %s: %s a %s", numero, numero - 1 + len(tramos), dias[0], dias[-1])
+                    try:
+                        ejecutar_tramo(organismos, dias[0], dias[-1], args, logger, cache, bitacora, plan)
+                        break
+                    except ErrorCuotaAgotada:
+                        if not args.esperar_cuota:
+                            raise
+                        esperar_reinicio_cuota(logger)
+                pendientes = pendientes[len(dias) :]
+            if pendientes:
+                # Tras cada tramo se vuelve a leer la cuota y a estimar lo que falta: si el resto cabe en lo
+                # que queda hoy se sigue sin esperar al reinicio.
+                tramos = planificar_cuota(plan, args, cache, bitacora, logger, desde_dt=pendientes[0])
+        if marcas is not None:
+            sincronizados = dias_sincronizados(plan, args.hasta, bitacora)
+            marcas.actualizar(
+                {clave_marca(organismo, args.proveedores): dia for organismo, dia in sincronizados.items()}
+            )
+            logger.info(
+                "Marcas de sincronización actualizadas para %s organismos en %s", len(sincronizados), marcas.ruta
+            )
+    except ErrorFatalApi as exc:
+        logger.error("%s", exc)
+        registrar_resumen(logger)
+        duplicar_log()
+        return 1
     except Exception as exc:  # pragma: no cover
         logger.exception("Error inesperado: %s", exc)
+        registrar_resumen(logger)
         duplicar_log()
         return 1
-
+    finally:
+        if bitacora is not None:
+            bitacora.cerrar()
+        registro_cuota.guardar()
+        if _COBERTURA is not None:
+            _COBERTURA.cerrar()
+        cerrar_transporte()
+        if cache is not None:
+            cache.guardar_latencias(latencias_observadas())
+            cache.cerrar()
+
+    if _CONCURRENCIA is not None:
+        logger.info("Concurrencia adaptativa final: %s peticiones simultáneas", _CONCURRENCIA.nivel)
+    registrar_resumen(logger)
     logger.info("Proceso finalizado")
     duplicar_log()
     return 0